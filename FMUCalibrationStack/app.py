@@ -97,6 +97,22 @@ class FMUCalibrationStack(Stack):
                                     )
         job_queue.add_compute_environment(batch_compute_environment, 1)
 
+        #in service mode every job keeps calibrating for service_runtime_min
+        #minutes and the next one is scheduled a minute later. The rule does
+        #not wait for the previous job, the lease on the savepoint (see
+        #source/savepoint.py) keeps overlapping jobs from both filtering
+        command = ['python3.10', 'fmu_calibrate.py']
+        schedule_minutes = int(json_setup['scheduler_waittime_min'])
+        if json_setup.get('calibration_service', False):
+            command.append('--service')
+            schedule_minutes = int(json_setup.get('service_runtime_min', 59)) + 1
+
+        #the local tier of the fmu result cache lives in /dev/shm, docker only
+        #gives it 64 MB. Room for the cache limit, the overshoot of the
+        #processes writing between their size checks and the semaphores of
+        #the worker pool; it counts against the job memory
+        shared_memory_mb = int(1.5 * json_setup.get('fmu_cache_local_mb', 32)) + 64
+
         #define Batch job
         #https://docs.aws.amazon.com/cdk/api/v2/python/aws_cdk.aws_batch/CfnJobDefinition.html
         job_definition = batch.CfnJobDefinition(self, "JobDefinitionL4DT",
@@ -104,25 +120,30 @@ class FMUCalibrationStack(Stack):
                                                    container_properties=batch.CfnJobDefinition.ContainerPropertiesProperty(
                                                                    image=json_setup['calibration_container_image'],
                                                                    #TODO: make this modifiable from json
-                                                                   command=['python3.10', 'fmu_calibrate.py'],
+                                                                   command=command,
                                                                    #execution_role_arn= batch_compute_environment.instance_role,
                                                                    log_configuration=batch.CfnJobDefinition.LogConfigurationProperty(
                                                                        log_driver="awslogs"),
                                                                    vcpus=json_setup['vCPU'],
-                                                                   memory=json_setup['Mem'])
+                                                                   memory=json_setup['Mem'],
+                                                                   linux_parameters=batch.CfnJobDefinition.LinuxParametersProperty(
+                                                                       shared_memory_size=shared_memory_mb))
                                                   )
 
         # Create an EventBridge rule to trigger the Batch job
         rule = events.Rule(
             self, "EventRuleL4DT",
-            schedule=events.Schedule.rate( Duration.minutes(int(json_setup['scheduler_waittime_min']) ) )
+            schedule=events.Schedule.rate( Duration.minutes(schedule_minutes) )
         )
 
-        # Add the Batch job as a target for the EventBridge rule
+        # Add the Batch job as a target for the EventBridge rule, with several
+        # assets it is submitted as an array job with one child per asset
+        calibration_assets = json_setup.get('calibration_assets', ["web-handling-Asset"])
         rule.add_target(targets.BatchJob(
             job_queue.job_queue_arn, job_queue,
             job_definition.ref,
-            job_definition
+            job_definition,
+            size=len(calibration_assets) if len(calibration_assets) > 1 else None
         ))
 
 
@@ -163,14 +184,33 @@ class FMUCalibrationStack(Stack):
             asset_model_properties=iot_model_properties
             )
 
-        # Create an Asset using the Asset Model
-        cfn_asset = iotsitewise.CfnAsset(self, "MyCfnAsset",
-            asset_model_id=cfn_asset_model.attr_asset_model_id,
-            asset_name="web-handling-Asset",
-            # the properties below are optional
-            asset_description="assetDescription",
-            asset_properties=iot_asset_properties
-        )
+        # Create one Asset per calibrated line using the Asset Model, the
+        # calibration job finds them as MyCfnAsset, MyCfnAsset1, ...
+        cfn_assets = []
+        for i, asset_name in enumerate(calibration_assets):
+            cfn_assets.append(iotsitewise.CfnAsset(self,
+                "MyCfnAsset" if i == 0 else f"MyCfnAsset{i}",
+                asset_model_id=cfn_asset_model.attr_asset_model_id,
+                asset_name=asset_name,
+                # the properties below are optional
+                asset_description="assetDescription",
+                asset_properties=iot_asset_properties
+            ))
+        cfn_asset = cfn_assets[0]
+
+        # Hand the physical ids to the calibration job as a small versioned
+        # document (see source/stack_metadata.py), the job then never queries
+        # CloudFormation and a stack update deploys the new ids with it
+        stack_metadata = {
+            "format": 1,
+            "stack_name": self.stack_name,
+            "resources": {"datalake": s3_bucket.bucket_name}
+        }
+        for i, asset in enumerate(cfn_assets):
+            stack_metadata["resources"]["MyCfnAsset" if i == 0 else f"MyCfnAsset{i}"] = asset.attr_asset_id
+        job_definition.add_property_override("ContainerProperties.Environment", [
+            {"Name": "STACK_METADATA", "Value": self.to_json_string(stack_metadata)}
+        ])
 
         twinmaker_workspace = self.create_twinmaker_workspace(json_setup['twinmaker_workspace_name'], s3_bucket)
         twinmaker_workspace.node.add_dependency(s3_bucket)
@@ -298,11 +338,13 @@ class FMUCalibrationStack(Stack):
          batch_instance_role.add_to_policy(iam.PolicyStatement(
              actions=[
                       "iotsitewise:BatchPutAssetPropertyValue",
+                      "iotsitewise:BatchGetAssetPropertyValueHistory",
                       "iotsitewise:Describe*",
                       "iotsitewise:Get*",
                       "iotsitewise:ListTimeSeries",
                       "iotsitewise:ListAssets",
-                      "cloudformation:ListStackResources"
+                      "cloudformation:ListStackResources",
+                      "cloudformation:DescribeStacks"
                       ],
              resources=["*"],
          ))
@@ -390,6 +432,12 @@ for key, value in json_setup.items():
         asset_lst.append(value+"_upper")
 json_setup['asset_properties'] = asset_lst
 
+#size the batch job from the measured profile, see source/compute_profile.py
+if os.path.isfile('../compute_profile.json'):
+    compute_profile = get_json('../compute_profile.json')
+    json_setup['vCPU'] = compute_profile['vCPU']
+    json_setup['Mem'] = compute_profile['Mem']
+
 #%% synthesize the cloud formation script
 app = App()
 stack = FMUCalibrationStack(app, "FMUCalibrationStack", json_setup,
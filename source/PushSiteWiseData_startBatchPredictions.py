@@ -5,61 +5,135 @@
 ######################################################################
 
 #generic packages
+import time
 import pandas
 from datetime import datetime
 import numpy as np
 from tqdm import tqdm
-from joblib import Parallel, delayed
 
 #twinmodule packages
-from twinmodules.core.util import get_user_json_config, get_cloudformation_metadata
-from twinmodules.AWSModules.AWS_sitewise import send_asset_property_data
+from twinmodules.core.util import get_user_json_config
 
+#local packages
+from sitewise_io import get_property_ids, SiteWiseBatchWriter
+from sitewise_io import get_calibration_assets, get_asset_id
+from stack_metadata import get_stack_resources
 
 
-#-------------------------------------------------------------------------------
 
-def simulate_data_into_sitewise(assetId, config):
+#-------------------------------------------------------------------------------
 
-    df= pandas.read_csv("./assets/Case_1_Data_2023_06_22.csv", header=1)
+def load_replay_data(config, filename="./assets/Case_1_Data_2023_06_22.csv"):
+    '''
+    Read the sample data once and map the roller columns to their SiteWise
+    measured property names.
+    '''
+    df= pandas.read_csv(filename, header=1)
     #need to makesure we stick with sitewise schema
     df = df.astype('float64')
 
-    #get to the action
-    #df = df.tail(2000-1350)
-
     roller_names = [x for x in df.columns if "Main.R" in x and 'SlipVelocity' not in x]
     sitewise_names = [value for key, value in config.items() if 'measured' in key]
 
-    chunksize= 3
-    t = np.linspace(0,10,num = chunksize)
-    for chunk in tqdm(range(0,df.shape[0],chunksize)):
-
-        dt = datetime.today()
-        now = dt.timestamp()
-
-        def send(col):
-            number = col.split('R')[-1].split('.')[0]
-            roller_data = df[col].iloc[chunk:chunk + chunksize]
-            #print(roller_data)
-            sitewise_name = [x for x in sitewise_names if number + '_' in x][0]
-            send_asset_property_data( sitewise_name,
-                                      t,
-                                      roller_data,
-                                      assetId=assetId,
-                                      use_current_time=False,
-                                      use_time=now)
-        Parallel(n_jobs=-1)(delayed(send)(col) for col in roller_names)
+    columns = {}
+    for col in roller_names:
+        number = col.split('R')[-1].split('.')[0]
+        sitewise_name = [x for x in sitewise_names if number + '_' in x][0]
+        columns[sitewise_name] = df[col].to_numpy()
+    return df['t'].to_numpy(), columns
+
+
+def simulate_data_into_sitewise(assetId, config, rate=1296.0, batch_rows=10,
+                                flush_interval=0.5, max_in_flight=64,
+                                client=None, filename="./assets/Case_1_Data_2023_06_22.csv"):
+    '''
+    Replay the sample data into SiteWise through one long-lived batch writer.
+
+    :param rate: replay speed relative to the data time stamps, 1 is real
+                 time, N is N times faster and 0 is as fast as possible. The
+                 default replays one 21.6 min sample per second.
+    :param batch_rows: rows packed together before sending, 10 rows of all
+                       properties fill the 10 values per entry API limit
+    :param flush_interval: wall seconds after which a partial batch is sent
+    :param max_in_flight: requests queued before the replay waits
+    :return: points sent per second
+    '''
+    t, columns = load_replay_data(config, filename)
+    property_ids = get_property_ids(assetId, client)
+    nrows = t.shape[0]
+
+    start = datetime.today().timestamp()
+    wall_start = time.perf_counter()
+    if rate > 0:
+        #timestamps follow the wall clock of the replay
+        timestamps = start + (t - t[0]) / rate
+        due = (t - t[0]) / rate
+    else:
+        #back date one second per row so nothing lands in the future
+        timestamps = start - np.arange(nrows)[::-1]
+        due = np.zeros((nrows,))
+
+    in_flight = []
+    with SiteWiseBatchWriter(assetId, property_ids, client,
+                             max_workers=config.get('sitewise_max_workers', 16)
+                             ) as writer:
+        first = 0
+        last_flush = time.perf_counter()
+        for i in tqdm(range(nrows)):
+            wait = due[i] - (time.perf_counter() - wall_start)
+            if wait > 0:
+                time.sleep(wait)
+
+            pending = i + 1 - first
+            if pending >= batch_rows or i == nrows - 1 \
+                    or time.perf_counter() - last_flush >= flush_interval:
+                rows = slice(first, i + 1)
+                in_flight.extend(writer.submit({name: (timestamps[rows], data[rows])
+                                                for name, data in columns.items()}))
+                first = i + 1
+                last_flush = time.perf_counter()
+
+            #backpressure, do not queue faster than the writer drains
+            while len(in_flight) > max_in_flight:
+                writer.stats.append(in_flight.pop(0).result())
+
+        for future in in_flight:
+            writer.stats.append(future.result())
+
+    elapsed = time.perf_counter() - wall_start
+    points = nrows * len(columns)
+    print(f"Replayed {points} points in {elapsed:.2f} s "
+          +f"({points/elapsed:.0f} points/s, {len(writer.stats)} requests)")
+    return points / elapsed
 
 #-------------------------------------------------------------------------------
 #%% main
 if __name__ == '__main__':
 
-    metadata = get_cloudformation_metadata('FMUCalibrationStack')
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rate', type=float, default=1296.0,
+                        help='replay speed, 1 is real time, 0 as fast as possible')
+    parser.add_argument('--batch-rows', type=int, default=10)
+    parser.add_argument('--local', action='store_true',
+                        help='replay into an in-process SiteWise stand-in')
+    parser.add_argument('--asset-index', type=int, default=0,
+                        help='entry of calibration_assets to replay into')
+    args = parser.parse_args()
 
     config_filename = "iot_config.json"
     config = get_user_json_config(config_filename)
 
-    #add dummy data to IoT SiteWise
-    assetId = metadata['MyCfnAsset']
-    simulate_data_into_sitewise(assetId, config)
\ No newline at end of file
+    if args.local:
+        from local_stubs import LocalSiteWiseClient
+        client = LocalSiteWiseClient()
+        assetId = client.create_asset(get_calibration_assets(config)[args.asset_index],
+                        [value for key, value in config.items() if 'measured' in key])
+    else:
+        metadata = get_stack_resources('FMUCalibrationStack')
+        client = None
+        #add dummy data to IoT SiteWise
+        assetId = get_asset_id(config, metadata, args.asset_index)
+
+    simulate_data_into_sitewise(assetId, config, rate=args.rate,
+                                batch_rows=args.batch_rows, client=client)
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+######################################################################
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved. #
+# SPDX-License-Identifier: MIT-0                                     #
+######################################################################
+'''
+Offline benchmark of the whole calibration job without a deployed stack.
+
+    python ./source/benchmark_calibration.py --rows 20
+    python ./source/benchmark_calibration.py --rows 20 --save-baseline benchmark_baseline.json
+    python ./source/benchmark_calibration.py --rows 20 --baseline benchmark_baseline.json
+
+The sample data is replayed into an in-process SiteWise stand-in, the
+savepoint and FMU cache live in a temporary folder instead of S3, and
+get_data(), calibrate() and make_prediction() run unchanged with the real
+FMU. Reports rows filtered per second, state function evaluations per row,
+peak memory and the time per stage. With --baseline the run fails if it is
+slower or larger than the baseline by more than --threshold.
+'''
+
+#generic packages
+import os
+import sys
+import json
+import time
+import resource
+import argparse
+import tempfile
+
+#local packages
+from local_stubs import LocalSiteWiseClient, asset_property_names
+from savepoint import CalibrationSavepoint
+from PushSiteWiseData_startBatchPredictions import simulate_data_into_sitewise
+import fmu_calibrate
+import metrics
+
+
+def run_benchmark(config:dict, rows:int, data_file:str) -> dict:
+    '''
+    Run one calibration job against the local stand-ins, returns the
+    measured figures.
+    '''
+    client = LocalSiteWiseClient()
+    assetId = client.create_asset('web-handling-Asset', asset_property_names(config))
+    metadata = {'MyCfnAsset': assetId}
+
+    config = dict(config)
+    config['sitewise_initial_points'] = rows
+    config['calibration_assets'] = ['web-handling-Asset']
+
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as workdir:
+        config['fmu_cache_dir'] = os.path.join(workdir, 'fmu_cache')
+        config.pop('fmu_cache_s3_bucket', None)
+        simulate_data_into_sitewise(assetId, config, rate=0, client=client,
+                                    filename=data_file)
+        os.chdir(workdir)
+        try:
+            metrics.configure(config)
+            savepoint = CalibrationSavepoint(None, fmu_calibrate.ukf_savepoint)
+            with metrics.span('get_data'):
+                dfsw = fmu_calibrate.get_data(config, metadata, savepoint, client)
+            t0 = time.perf_counter()
+            with metrics.span('calibrate'):
+                fmu_calibrate.calibrate(dfsw, config, metadata, savepoint)
+            calibrate_seconds = time.perf_counter() - t0
+            with metrics.span('make_prediction'):
+                fmu_calibrate.make_prediction(dfsw, config, metadata, client)
+        finally:
+            os.chdir(cwd)
+
+    summary = metrics.get_summary()
+    observations = summary['observations']
+    n_rows = dfsw.shape[0]
+    return {'rows': n_rows,
+            'rows_per_second': n_rows / calibrate_seconds,
+            'evaluations_per_row': summary['counters'].get('state_evaluations', 0) / max(n_rows, 1),
+            #ru_maxrss is reported in kB on linux
+            'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+            'peak_worker_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+            #fmu figures are only seen here without a worker pool, pool
+            #workers write their own summary line
+            'fmu_steps_per_run': observations.get('fmu_ss_steps', {}).get('mean'),
+            'stage_seconds': {name: stats['sum'] for name, stats in observations.items()
+                              if name != 'fmu_ss_steps'}}
+
+
+def check_regression(result:dict, baseline:dict, threshold:float) -> list:
+    '''
+    Returns the failed checks, empty if the result is within threshold of
+    the baseline.
+    '''
+    failed = []
+    if result['rows_per_second'] < baseline['rows_per_second'] * (1 - threshold):
+        failed.append(f"rows/s {result['rows_per_second']:.3f} < "
+                      +f"baseline {baseline['rows_per_second']:.3f}")
+    for key in ['evaluations_per_row', 'peak_rss_mb', 'peak_worker_rss_mb']:
+        if result[key] > baseline[key] * (1 + threshold):
+            failed.append(f"{key} {result[key]:.1f} > baseline {baseline[key]:.1f}")
+    return failed
+
+
+#%% main
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default='iot_config.json')
+    parser.add_argument('--fmu', default='./assets/web_line_3_linux.fmu',
+                        help='override the fmu_file entry of the config')
+    parser.add_argument('--data', default='./assets/Case_1_Data_2023_06_22.csv')
+    parser.add_argument('--rows', type=int, default=20,
+                        help='latest rows of the replayed data to calibrate on')
+    parser.add_argument('--baseline', default=None,
+                        help='json of an earlier run to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='allowed relative regression against the baseline')
+    parser.add_argument('--save-baseline', default=None)
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.config):
+        sys.exit(f"ERROR: couldnt find {args.config} "
+                 +"try running this file one directory higher.")
+    with open(args.config,'r') as f:
+        config = json.load(f)
+    config['fmu_file'] = os.path.abspath(args.fmu)
+    data_file = os.path.abspath(args.data)
+
+    result = run_benchmark(config, args.rows, data_file)
+    print(f"{result['rows']} rows: {result['rows_per_second']:.3f} rows/s, "
+          +f"{result['evaluations_per_row']:.1f} state evaluations/row, "
+          +f"peak rss {result['peak_rss_mb']:.0f} MB main, "
+          +f"{result['peak_worker_rss_mb']:.0f} MB worker")
+    if result['fmu_steps_per_run'] is not None:
+        print(f"{result['fmu_steps_per_run']:.0f} fmu steps per run")
+    for name, seconds in sorted(result['stage_seconds'].items(), key=lambda x: -x[1]):
+        print(f"{name:>24s}: {seconds:9.3f} s")
+
+    if args.save_baseline is not None:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(result, f, indent=4)
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        failed = check_regression(result, baseline, args.threshold)
+        for message in failed:
+            print(f"REGRESSION: {message}")
+        if len(failed) > 0:
+            sys.exit(1)
+        print(f"no regression beyond {args.threshold:.0%} of {args.baseline}")
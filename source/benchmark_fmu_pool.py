@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+######################################################################
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved. #
+# SPDX-License-Identifier: MIT-0                                     #
+######################################################################
+'''
+Per-sigma-point latency of the FMU state function with and without the
+persistent FMU instance pool.
+
+    python ./source/benchmark_fmu_pool.py --fmu ./assets/web_line_3_linux.fmu
+
+The baseline is the twinmodules run_fmu call the pool replaces, through
+the same wrapper the calibration uses, and is skipped where twinmodules is
+not installed. The reload path loads, instantiates and frees the FMU with
+fmpy for every evaluation, it isolates the load cost the pool removes but
+is not the twinmodules call. The warm path restarts each solve from the
+converged state of a previous, nearby solve.
+'''
+
+#generic packages
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+#local packages
+from fmu_pool import FMUInstance, get_fmu_names, run_pooled_fmu, get_pool_stats
+
+
+def sigma_like_inputs(n_inputs:int, n_points:int, seed:int=0) -> np.array:
+    #small perturbations around a typical calibrated damping vector
+    rng = np.random.default_rng(seed)
+    center = np.ones((n_inputs,)) * 1e-3
+    return np.clip(center + rng.normal(0, 5e-3, size=(n_points, n_inputs)), 0, 0.5)
+
+
+def get_twinmodules_run():
+    #the wrapper fmu_calibrate uses when fmu_instance_pool is false
+    try:
+        from fmu_calibrate import run_twinmodules_fmu
+        from twinmodules.core.components import run_fmu
+    except ImportError:
+        return None
+    return run_twinmodules_fmu
+
+
+def run_reload(inputs:np.array, config:dict):
+    input_names, output_names = get_fmu_names(config)
+    instance = FMUInstance(config['fmu_file'], input_names, output_names)
+    try:
+        return instance.simulate(inputs,
+                                 config['fmu_step_size'],
+                                 config['fmu_stop_time'],
+                                 config['fmu_ss_iterations'],
+                                 config['fmu_ss_tolerance'])
+    finally:
+        instance.close()
+
+
+def time_calls(func, points:np.array, config:dict) -> np.array:
+    latency = []
+    for x in points:
+        t0 = time.perf_counter()
+        func(x, config)
+        latency.append(time.perf_counter() - t0)
+    return np.array(latency)
+
+
+def report(name:str, latency:np.array):
+    print(f"{name:>8s}: mean {latency.mean()*1e3:9.2f} ms   "
+          f"p50 {np.percentile(latency,50)*1e3:9.2f} ms   "
+          f"max {latency.max()*1e3:9.2f} ms   "
+          f"total {latency.sum():7.2f} s")
+
+
+def speedup(baseline, reload:np.array, latency:np.array):
+    if baseline is not None:
+        print(f"per sigma point speedup over twinmodules run_fmu: "
+              +f"{baseline.mean()/latency.mean():.2f}x")
+    print(f"per sigma point speedup over reloading the fmu: "
+          +f"{reload.mean()/latency.mean():.2f}x")
+
+
+#%% main
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default='iot_config.json')
+    parser.add_argument('--fmu', default=None,
+                        help='override the fmu_file entry of the config')
+    parser.add_argument('--n-points', type=int, default=37,
+                        help='sigma points to evaluate (2n+1 for n=18 is 37)')
+    parser.add_argument('--stop-time', type=float, default=None,
+                        help='shorten fmu_stop_time to isolate load overhead')
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.config):
+        sys.exit(f"ERROR: couldnt find {args.config} "
+                 +"try running this file one directory higher.")
+    with open(args.config,'r') as f:
+        config = json.load(f)
+    if args.fmu is not None:
+        config['fmu_file'] = args.fmu
+    if args.stop_time is not None:
+        config['fmu_stop_time'] = args.stop_time
+
+    input_names, _ = get_fmu_names(config)
+    points = sigma_like_inputs(len(input_names), args.n_points)
+
+    print(f"Evaluating {args.n_points} sigma points of {config['fmu_file']}")
+    run_twinmodules = get_twinmodules_run()
+    if run_twinmodules is None:
+        print("twinmodules is not installed, no twinmodules run_fmu baseline")
+        baseline = None
+    else:
+        baseline = time_calls(run_twinmodules, points, config)
+        report('twinmod', baseline)
+    reload = time_calls(run_reload, points, config)
+    report('reload', reload)
+    #first pooled call pays the one-off load, report it separately
+    config['fmu_warm_start'] = False
+    t0 = time.perf_counter()
+    run_pooled_fmu(points[0], config)
+    print(f"pool load + first call: {(time.perf_counter()-t0)*1e3:.2f} ms")
+    pooled = time_calls(run_pooled_fmu, points, config)
+    report('pooled', pooled)
+    speedup(baseline, reload, pooled)
+
+    #warm start from the previous pass, as consecutive ukf steps would
+    config['fmu_warm_start'] = True
+    time_calls(run_pooled_fmu, points, config)
+    warm = time_calls(run_pooled_fmu, points * 1.01, config)
+    report('warm', warm)
+    speedup(baseline, reload, warm)
+    for stats in get_pool_stats():
+        print(f"steady-state steps saved by warm start: ~{stats['steps_saved']}")
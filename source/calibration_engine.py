@@ -0,0 +1,609 @@
+# -*- coding: utf-8 -*-
+######################################################################
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved. #
+# SPDX-License-Identifier: MIT-0                                     #
+######################################################################
+
+#generic packages
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+
+def available_cpus() -> int:
+    #cores this process may run on, os.cpu_count() reports the host's cores
+    #inside a batch container
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+
+def sigma_point_workers(n_points:int, max_workers:int=None) -> int:
+    '''
+    Fewest workers that evaluate n_points sigma points in as few rounds as
+    max_workers would, e.g. 37 points on 16 cores need 3 rounds, which 13
+    workers already achieve.
+    '''
+    if max_workers is None or max_workers < 1:
+        max_workers = available_cpus()
+    rounds = -(-n_points // max_workers)
+    return -(-n_points // rounds)
+
+
+class StreamingUKF(object):
+    '''
+    Unscented Kalman filter that stays alive across measurements. The sigma
+    point weights and the worker pool evaluating the state function are
+    created once, the mean and covariance are carried internally and every
+    call to step() performs one predict/update cycle.
+
+    :param state_func: picklable callable mapping a state vector to the next
+                       state vector, e.g. my_transition_function.run_my_fmu.
+                       Entries returned after the n state entries are extra
+                       outputs, see output_moments
+    :param initial_state: state mean to start filtering from
+    :param initial_state_covariance: state covariance to start filtering from
+    :param measurement_noise: measurement covariance (n_observed x n_observed)
+    :param process_noise: additive process covariance (n x n)
+    :param n_observed: the first n_observed states are measured directly
+    :param constrain: optional callable applied to the mean after each update
+    :param ncpu: worker processes for the state function, -1 sizes the pool
+                 to the sigma points with sigma_point_workers
+    :param initializer: worker initializer, e.g. fmu_pool.init_worker
+    :param surrogate: optional fmu_surrogate.PolynomialSurrogate, sigma points
+                      it predicts within tolerance skip the state function
+    :param gate_threshold: optional squared Mahalanobis distance of the
+                           innovation below which step() only inflates the
+                           covariance instead of propagating sigma points
+    :param gate_max_skips: consecutive steps the gate may skip before a full
+                           step is forced, 0 for no limit
+    '''
+    def __init__(self, state_func,
+                 initial_state:np.array,
+                 initial_state_covariance:np.array,
+                 measurement_noise:np.array,
+                 process_noise:np.array,
+                 n_observed:int,
+                 constrain=None,
+                 alpha:float=1.0,
+                 beta:float=2.0,
+                 kappa:float=0.0,
+                 ncpu:int=-1,
+                 initializer=None,
+                 initargs:tuple=(),
+                 surrogate=None,
+                 gate_threshold:float=None,
+                 gate_max_skips:int=0):
+        self.state_func = state_func
+        self.mean = np.array(initial_state, dtype='float64')
+        self.covariance = np.array(initial_state_covariance, dtype='float64')
+        self.measurement_noise = np.array(measurement_noise, dtype='float64')
+        self.process_noise = np.array(process_noise, dtype='float64')
+        self.constrain = constrain
+        self.surrogate = surrogate
+        self.gate_threshold = gate_threshold
+        self.gate_max_skips = gate_max_skips
+        self.n = self.mean.shape[0]
+        self.n_observed = n_observed
+        self.observation_matrix = np.eye(self.n)[:n_observed]
+
+        #sigma point weights only depend on the state dimension
+        n = self.n
+        self.lam = alpha**2 * (n + kappa) - n
+        self.Wm = np.full(2*n + 1, 0.5 / (n + self.lam))
+        self.Wc = self.Wm.copy()
+        self.Wm[0] = self.lam / (n + self.lam)
+        self.Wc[0] = self.Wm[0] + (1 - alpha**2 + beta)
+
+        if ncpu == -1:
+            #more workers than sigma points per round would only sit idle
+            ncpu = sigma_point_workers(self.points_per_step())
+        self.ncpu = ncpu
+        self.executor = None
+        if ncpu > 1:
+            self.executor = ProcessPoolExecutor(max_workers=ncpu,
+                                                initializer=initializer,
+                                                initargs=initargs)
+        elif initializer is not None:
+            initializer(*initargs)
+        self.n_steps = 0
+        self.n_evaluations = 0
+        self.n_gated = 0
+        self.n_skipped = 0
+        #mean the gate last evaluated and the full state function output
+        self.gate_point = None
+        #propagated states and extra outputs of the points of the last full
+        #dispatch
+        self.last_states = None
+        self.last_outputs = None
+
+    def points_per_step(self) -> int:
+        return 2*self.n + 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    def sigma_points(self, mean:np.array, covariance:np.array) -> np.array:
+        scaled = (self.n + self.lam) * covariance
+        try:
+            root = np.linalg.cholesky(scaled)
+        except np.linalg.LinAlgError:
+            #clipping and tiny noise values can cost positive definiteness,
+            #fall back to the symmetric square root of the psd part
+            w, v = np.linalg.eigh(0.5 * (scaled + scaled.T))
+            root = v * np.sqrt(np.clip(w, 0, None))
+        return np.vstack((mean, mean + root.T, mean - root.T))
+
+    def evaluate(self, sigmas:np.array, background=None) -> np.array:
+        '''
+        Run the state function on every sigma point. The optional background
+        callable runs in this process while the workers are busy. A first
+        point at the mean the gate already evaluated (the centre sigma
+        point) reuses that run.
+        '''
+        reused = self.gate_point is not None and sigmas.shape[0] > 1 \
+            and np.array_equal(sigmas[0], self.gate_point[0])
+        if reused:
+            sigmas = sigmas[1:]
+        self.n_evaluations += sigmas.shape[0]
+        if self.executor is None:
+            if background is not None:
+                background()
+            evaluated = [self.state_func(x) for x in sigmas]
+        else:
+            futures = [self.executor.submit(self.state_func, x) for x in sigmas]
+            if background is not None:
+                background()
+            evaluated = [future.result() for future in futures]
+        if reused:
+            evaluated.insert(0, self.gate_point[1])
+        return np.array(evaluated)
+
+    def propagate(self, sigmas:np.array, background=None) -> np.array:
+        if self.surrogate is None:
+            evaluated = self.evaluate(sigmas, background)
+            self.last_states = evaluated[:, :self.n]
+            self.last_outputs = evaluated[:, self.n:] if evaluated.shape[1] > self.n else None
+            return evaluated[:, :self.n]
+
+        #only the sigma points the surrogate is unsure about run the fmu,
+        #and those runs keep training the surrogate
+        predicted, trusted = self.surrogate.predict(sigmas)
+        propagated = np.zeros_like(sigmas) if predicted is None else predicted
+        #the surrogate only predicts the state, extra outputs need every point
+        self.last_outputs = None
+        if not np.all(trusted):
+            evaluated = self.evaluate(sigmas[~trusted], background)
+            propagated[~trusted] = evaluated[:, :self.n]
+            self.surrogate.add_samples(sigmas[~trusted], evaluated[:, :self.n])
+            if np.all(~trusted) and evaluated.shape[1] > self.n:
+                self.last_states = evaluated[:, :self.n]
+                self.last_outputs = evaluated[:, self.n:]
+        elif background is not None:
+            background()
+        return propagated
+
+    def output_moments(self) -> tuple:
+        '''
+        Mean and variance of the extra state function outputs at the current
+        (updated) state, without further state function runs. None if the
+        last step had no extra outputs for every point.
+        '''
+        if self.last_outputs is None:
+            return None
+        return self.posterior_moments(self.Wm, self.Wc)
+
+    def posterior_moments(self, Wm:np.array, Wc:np.array) -> tuple:
+        '''
+        The outputs of the points of the last full dispatch describe the
+        prediction, before the measurement update. They are regressed on the
+        propagated states of the same runs and the regression is evaluated
+        at the current mean and covariance, the scatter around it is kept in
+        the variance.
+        '''
+        state_mean = Wm @ self.last_states
+        output_mean = Wm @ self.last_outputs
+        dx = self.last_states - state_mean
+        dz = self.last_outputs - output_mean
+        #states of very different magnitude, scale before the pseudo
+        #inverse, the propagated states only span the damping directions
+        scale = np.sqrt(np.clip(Wc @ dx**2, 0, None))
+        scale[scale == 0] = 1.0
+        dx_scaled = dx / scale
+        Pxx = (Wc * dx_scaled.T) @ dx_scaled
+        Pzx = (Wc * dz.T) @ dx_scaled
+        A = Pzx @ np.linalg.pinv(Pxx, rcond=1e-10, hermitian=True) / scale
+        residual = dz - dx @ A.T
+        mean = output_mean + A @ (self.mean - state_mean)
+        variance = np.einsum('ij,jk,ik->i', A, self.covariance, A) + Wc @ residual**2
+        return mean, np.clip(variance, 0, None)
+
+    def innovation_distance(self, y:np.array) -> float:
+        '''
+        Squared Mahalanobis distance of the measurement from the state
+        function evaluated once at the current mean, against the measurement
+        noise. The state covariance is left out, gated steps keep inflating
+        it with the process noise and would open the gate ever wider. The
+        evaluation is reused while the mean does not change, and as the
+        centre sigma point of the next full step.
+        '''
+        if self.gate_point is None or not np.array_equal(self.gate_point[0], self.mean):
+            self.gate_point = (self.mean.copy(), self.evaluate(self.mean[None])[0])
+        innovation = np.asarray(y, dtype='float64') \
+            - self.observation_matrix @ self.gate_point[1][:self.n]
+        return float(innovation @ np.linalg.solve(self.measurement_noise, innovation))
+
+    def inflate(self):
+        #the state persists, only the process noise is added
+        self.covariance = self.covariance + self.process_noise
+
+    def gate(self, y:np.array, background=None) -> bool:
+        '''
+        True if the measurement is within gate_threshold of the current
+        state, the step is then reduced to inflating the covariance.
+        '''
+        if self.gate_threshold is None \
+            or (self.gate_max_skips > 0 and self.n_skipped >= self.gate_max_skips):
+            self.n_skipped = 0
+            return False
+        if self.innovation_distance(y) > self.gate_threshold:
+            self.n_skipped = 0
+            return False
+        if background is not None:
+            background()
+        self.inflate()
+        self.n_skipped += 1
+        self.n_gated += 1
+        self.n_steps += 1
+        return True
+
+    def predict(self, background=None) -> tuple:
+        sigmas = self.sigma_points(self.mean, self.covariance)
+        propagated = self.propagate(sigmas, background)
+        mean = self.Wm @ propagated
+        residual = propagated - mean
+        covariance = (self.Wc * residual.T) @ residual + self.process_noise
+        return mean, covariance
+
+    def update(self, y:np.array, mean:np.array, covariance:np.array) -> tuple:
+        H = self.observation_matrix
+        S = H @ covariance @ H.T + self.measurement_noise
+        K = np.linalg.solve(S, H @ covariance).T
+        mean = mean + K @ (np.asarray(y, dtype='float64') - H @ mean)
+        covariance = covariance - K @ S @ K.T
+        covariance = 0.5 * (covariance + covariance.T)
+        if self.constrain is not None:
+            mean = self.constrain(mean)
+        return mean, covariance
+
+    def step(self, y:np.array, background=None) -> tuple:
+        '''
+        Filter one measurement, returns the updated mean and covariance.
+        '''
+        if self.gate(y, background):
+            return self.mean, self.covariance
+        mean, covariance = self.predict(background)
+        self.mean, self.covariance = self.update(y, mean, covariance)
+        self.n_steps += 1
+        return self.mean, self.covariance
+
+    def step_block(self, Y:np.array, background=None) -> tuple:
+        '''
+        Fixed-lag approximation filtering the rows of Y with a single
+        dispatch of sigma points. The first row is an exact step. Between
+        the later rows the state is assumed to persist with the additive
+        process noise, the steady-state FMU outputs only change through the
+        damping coefficients, so the state function is re-evaluated once per
+        block. Returns the stacked means and covariances after each row.
+        '''
+        means = []
+        covariances = []
+        gated = self.gate(Y[0], background)
+        for i, y in enumerate(Y):
+            if i == 0 and gated:
+                means.append(self.mean.copy())
+                covariances.append(self.covariance.copy())
+                continue
+            if i == 0:
+                mean, covariance = self.predict(background)
+            else:
+                mean, covariance = self.mean, self.covariance + self.process_noise
+            self.mean, self.covariance = self.update(y, mean, covariance)
+            self.n_steps += 1
+            means.append(self.mean.copy())
+            covariances.append(self.covariance.copy())
+        return np.array(means), np.array(covariances)
+
+    def savepoint_arrays(self) -> dict:
+        '''
+        Filter specific arrays to keep in the savepoint next to the mean and
+        covariance.
+        '''
+        return {}
+
+    def update_batch(self, Y:np.array) -> tuple:
+        '''
+        Filter the rows of Y in order, returns the stacked means and
+        covariances after each row.
+        '''
+        means = []
+        covariances = []
+        for y in Y:
+            mean, covariance = self.step(y)
+            means.append(mean.copy())
+            covariances.append(covariance.copy())
+        return np.array(means), np.array(covariances)
+
+
+def cholupdate(root:np.array, x:np.array, sign:float=1.0) -> np.array:
+    '''
+    Rank one update of the lower triangular factor, returns the factor of
+    root @ root.T + sign * outer(x, x) in O(n^2). Raises LinAlgError if a
+    downdate loses positive definiteness.
+    '''
+    root = root.copy()
+    x = np.array(x, dtype='float64')
+    for k in range(x.shape[0]):
+        r2 = root[k, k]**2 + sign * x[k]**2
+        if r2 <= 0 or root[k, k] == 0:
+            raise np.linalg.LinAlgError("cholesky downdate is not positive definite")
+        r = np.sqrt(r2)
+        c = r / root[k, k]
+        s = x[k] / root[k, k]
+        root[k, k] = r
+        root[k+1:, k] = (root[k+1:, k] + sign * s * x[k+1:]) / c
+        x[k+1:] = c * x[k+1:] - s * root[k+1:, k]
+    return root
+
+
+def tria(A:np.array) -> np.array:
+    '''
+    Lower triangular factor L with L @ L.T == A @ A.T from a QR
+    decomposition, never squaring A. A needs at least as many columns as
+    rows.
+    '''
+    R = np.linalg.qr(A.T, mode='r')
+    #make the diagonal positive so the factor is a proper cholesky factor
+    signs = np.where(np.diag(R) < 0, -1.0, 1.0)
+    return (R * signs[:, None]).T
+
+
+def psd_root(covariance:np.array) -> np.array:
+    '''
+    Lower triangular factor of a covariance that may have lost positive
+    definiteness numerically.
+    '''
+    try:
+        return np.linalg.cholesky(covariance)
+    except np.linalg.LinAlgError:
+        w, v = np.linalg.eigh(0.5 * (covariance + covariance.T))
+        return tria(v * np.sqrt(np.clip(w, 0, None)))
+
+
+class SquareRootUKF(StreamingUKF):
+    '''
+    Square root form of StreamingUKF. The covariance is carried as its lower
+    triangular factor, the prediction factor comes from a QR decomposition of
+    the weighted sigma point residuals plus a rank one update for the
+    center point, and the update uses the Joseph form in factored form. The
+    covariance stays positive semi-definite by construction, even with the
+    very small noise values and the clipping of the damping coefficients.
+
+    Takes the arguments of StreamingUKF and
+
+    :param initial_root: lower triangular factor of initial_state_covariance,
+                         e.g. from a savepoint, computed if None
+    '''
+    def __init__(self, *args, initial_root:np.array=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        if initial_root is None:
+            initial_root = psd_root(self.covariance)
+        self.root = np.array(initial_root, dtype='float64')
+        self.process_root = psd_root(self.process_noise)
+        self.measurement_root = psd_root(self.measurement_noise)
+
+    def sigma_points(self, mean:np.array, root:np.array) -> np.array:
+        scaled = np.sqrt(self.n + self.lam) * root
+        return np.vstack((mean, mean + scaled.T, mean - scaled.T))
+
+    def predict(self, background=None) -> tuple:
+        sigmas = self.sigma_points(self.mean, self.root)
+        propagated = self.propagate(sigmas, background)
+        mean = self.Wm @ propagated
+        residual = propagated - mean
+        root = tria(np.hstack((np.sqrt(self.Wc[1]) * residual[1:].T, self.process_root)))
+        try:
+            root = cholupdate(root, np.sqrt(abs(self.Wc[0])) * residual[0],
+                              np.sign(self.Wc[0]))
+        except np.linalg.LinAlgError:
+            #negative center weight can fail, refactor once
+            root = psd_root(root @ root.T + self.Wc[0] * np.outer(residual[0], residual[0]))
+        return mean, root
+
+    def update(self, y:np.array, mean:np.array, root:np.array) -> tuple:
+        H = self.observation_matrix
+        innovation_root = tria(np.hstack((H @ root, self.measurement_root)))
+        #K = P H^T S^-1 with two triangular solves of the innovation factor
+        PHt = root @ (H @ root).T
+        K = np.linalg.solve(innovation_root.T,
+                            np.linalg.solve(innovation_root, PHt.T)).T
+        mean = mean + K @ (np.asarray(y, dtype='float64') - H @ mean)
+        #Joseph form (I-KH) P (I-KH)^T + K R K^T as a factor
+        root = tria(np.hstack(((np.eye(self.n) - K @ H) @ root,
+                               K @ self.measurement_root)))
+        if self.constrain is not None:
+            mean = self.constrain(mean)
+        return mean, root
+
+    def inflate(self):
+        self.root = tria(np.hstack((self.root, self.process_root)))
+        self.covariance = self.root @ self.root.T
+
+    def step(self, y:np.array, background=None) -> tuple:
+        if self.gate(y, background):
+            return self.mean, self.covariance
+        mean, root = self.predict(background)
+        self.mean, self.root = self.update(y, mean, root)
+        self.covariance = self.root @ self.root.T
+        self.n_steps += 1
+        return self.mean, self.covariance
+
+    def step_block(self, Y:np.array, background=None) -> tuple:
+        means = []
+        covariances = []
+        gated = self.gate(Y[0], background)
+        for i, y in enumerate(Y):
+            if i == 0 and gated:
+                means.append(self.mean.copy())
+                covariances.append(self.covariance)
+                continue
+            if i == 0:
+                mean, root = self.predict(background)
+            else:
+                mean, root = self.mean, tria(np.hstack((self.root, self.process_root)))
+            self.mean, self.root = self.update(y, mean, root)
+            self.covariance = self.root @ self.root.T
+            self.n_steps += 1
+            means.append(self.mean.copy())
+            covariances.append(self.covariance)
+        return np.array(means), np.array(covariances)
+
+    def savepoint_arrays(self) -> dict:
+        return {'covariance_root': self.root}
+
+
+def gaspari_cohn(distance:np.array, radius:float) -> np.array:
+    '''
+    Gaspari-Cohn taper, 1 at distance 0 and 0 beyond 2*radius.
+    '''
+    r = np.abs(np.asarray(distance, dtype='float64')) / radius
+    taper = np.zeros_like(r)
+    near = r <= 1
+    far = (r > 1) & (r < 2)
+    x = r[near]
+    taper[near] = -0.25*x**5 + 0.5*x**4 + 0.625*x**3 - 5/3*x**2 + 1
+    x = r[far]
+    taper[far] = x**5/12 - 0.5*x**4 + 0.625*x**3 + 5/3*x**2 - 5*x + 4 - 2/(3*x)
+    return taper
+
+
+def localization_matrix(positions:np.array, radius:float) -> np.array:
+    '''
+    Gaspari-Cohn tapering between state components at the given positions,
+    e.g. the roller index of every measured and damping state.
+    '''
+    positions = np.asarray(positions, dtype='float64')
+    return gaspari_cohn(positions[:, None] - positions[None, :], radius)
+
+
+class EnsembleKF(StreamingUKF):
+    '''
+    Stochastic ensemble Kalman filter with perturbed observations. The FMU
+    budget per step is the ensemble size, independent of the state
+    dimension. The ensemble is propagated by the same worker pool and
+    surrogate as the UKF, the analysis is a vectorized update of all
+    members.
+
+    Takes the arguments of StreamingUKF, the sigma point weights are unused,
+    and
+
+    :param ensemble_size: members, i.e. state function runs per step
+    :param localization: optional (n x n) taper multiplied into the ensemble
+                         covariances, see localization_matrix
+    :param initial_ensemble: (ensemble_size x n) members to continue from,
+                             e.g. from a savepoint, sampled if None
+    :param seed: seed of the member and observation perturbations
+    '''
+    def __init__(self, *args, ensemble_size:int=24, localization:np.array=None,
+                 initial_ensemble:np.array=None, seed:int=None, **kwargs):
+        self.ensemble_size = ensemble_size
+        super().__init__(*args, **kwargs)
+        self.localization = localization
+        self.rng = np.random.default_rng(seed)
+        self.process_root = psd_root(self.process_noise)
+        self.measurement_root = psd_root(self.measurement_noise)
+        if initial_ensemble is None or np.shape(initial_ensemble) != (ensemble_size, self.n):
+            initial_ensemble = self.mean + self.noise(psd_root(self.covariance))
+        self.ensemble = np.array(initial_ensemble, dtype='float64')
+
+    def points_per_step(self) -> int:
+        return self.ensemble_size
+
+    def output_moments(self) -> tuple:
+        if self.last_outputs is None:
+            return None
+        members = self.last_outputs.shape[0]
+        return self.posterior_moments(np.full(members, 1.0 / members),
+                                      np.full(members, 1.0 / (members - 1)))
+
+    def noise(self, root:np.array) -> np.array:
+        #one zero mean sample per member with covariance root @ root.T
+        return self.rng.standard_normal((self.ensemble_size, root.shape[1])) @ root.T
+
+    def constrain_members(self, ensemble:np.array) -> np.array:
+        if self.constrain is None:
+            return ensemble
+        return np.array([self.constrain(x) for x in ensemble])
+
+    def forecast(self, background=None) -> np.array:
+        return self.propagate(self.ensemble, background) + self.noise(self.process_root)
+
+    def analysis(self, y:np.array, ensemble:np.array) -> np.array:
+        n_obs = self.n_observed
+        anomalies = ensemble - ensemble.mean(axis=0)
+        Pxy = anomalies.T @ anomalies[:, :n_obs] / (self.ensemble_size - 1)
+        Pyy = Pxy[:n_obs]
+        if self.localization is not None:
+            Pxy = Pxy * self.localization[:, :n_obs]
+            Pyy = Pyy * self.localization[:n_obs, :n_obs]
+        K = np.linalg.solve(Pyy + self.measurement_noise, Pxy.T).T
+        observations = np.asarray(y, dtype='float64') + self.noise(self.measurement_root)
+        ensemble = ensemble + (observations - ensemble[:, :n_obs]) @ K.T
+        return self.constrain_members(ensemble)
+
+    def _store(self, ensemble:np.array):
+        self.ensemble = ensemble
+        self.mean = ensemble.mean(axis=0)
+        self.covariance = np.cov(ensemble, rowvar=False)
+        self.n_steps += 1
+
+    def inflate(self):
+        #zero mean perturbations, the mean and so the gate evaluation stay
+        noise = self.noise(self.process_root)
+        self.ensemble = self.ensemble + noise - noise.mean(axis=0)
+        self.covariance = np.cov(self.ensemble, rowvar=False)
+
+    def step(self, y:np.array, background=None) -> tuple:
+        if self.gate(y, background):
+            return self.mean, self.covariance
+        self._store(self.analysis(y, self.forecast(background)))
+        return self.mean, self.covariance
+
+    def step_block(self, Y:np.array, background=None) -> tuple:
+        means = []
+        covariances = []
+        gated = self.gate(Y[0], background)
+        for i, y in enumerate(Y):
+            if i == 0 and gated:
+                means.append(self.mean.copy())
+                covariances.append(self.covariance.copy())
+                continue
+            if i == 0:
+                ensemble = self.forecast(background)
+            else:
+                ensemble = self.ensemble + self.noise(self.process_root)
+            self._store(self.analysis(y, ensemble))
+            means.append(self.mean.copy())
+            covariances.append(self.covariance.copy())
+        return np.array(means), np.array(covariances)
+
+    def savepoint_arrays(self) -> dict:
+        return {'ensemble': self.ensemble}
@@ -0,0 +1,114 @@
+# -*- coding: utf-8 -*-
+######################################################################
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved. #
+# SPDX-License-Identifier: MIT-0                                     #
+######################################################################
+'''
+Recommend the vCPU/memory of the calibration batch job from the number of
+sigma points per UKF step and the measured memory of one FMU worker.
+
+    python ./source/compute_profile.py --write compute_profile.json
+
+FMUCalibrationStack uses compute_profile.json, when present, instead of the
+vCPU and Mem entries of the iot_config.json.
+'''
+
+#generic packages
+import os
+import sys
+import json
+import math
+import resource
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+#local packages
+from fmu_pool import init_worker, run_pooled_fmu, get_fmu_names
+from calibration_engine import sigma_point_workers
+
+
+def peak_rss_mb() -> float:
+    #ru_maxrss is reported in kB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _measure_worker(config:dict) -> float:
+    input_names, _ = get_fmu_names(config)
+    run_pooled_fmu(np.ones((len(input_names),)) * 1e-3, config)
+    return peak_rss_mb()
+
+
+def measure_worker_memory(config:dict) -> float:
+    '''
+    Peak memory in MB of one pool worker after loading the FMU and running
+    one evaluation, measured in a fresh process.
+    '''
+    with ProcessPoolExecutor(max_workers=1, initializer=init_worker,
+                             initargs=(config,)) as executor:
+        return executor.submit(_measure_worker, config).result()
+
+
+def n_sigma_points(config:dict) -> int:
+    #fmu runs per filter step, the enkf runs its ensemble instead
+    if config.get('calibration_filter', 'ukf') == 'enkf':
+        return config.get('enkf_ensemble_size', 24)
+    #state is the measured values followed by the damping coefficients
+    n_measured = len([key for key in config.keys() if 'measured' in key])
+    n_inputs = len(get_fmu_names(config)[0])
+    return 2 * (n_measured + n_inputs) + 1
+
+
+def recommend_profile(n_points:int, worker_mb:float, base_mb:float,
+                      rounds:int=1, headroom:float=1.25) -> dict:
+    '''
+    vCPU and memory (MB) for a job evaluating n_points sigma points in
+    `rounds` pool dispatches per UKF step.
+
+    :param worker_mb: peak memory of one FMU worker
+    :param base_mb: peak memory of the main process
+    :param rounds: dispatch rounds per step, more rounds trade step time
+                   for fewer vCPUs
+    :param headroom: safety factor applied to the memory estimate
+    '''
+    workers = sigma_point_workers(n_points, -(-n_points // rounds))
+    memory = (base_mb + workers * worker_mb) * headroom
+    return {'vCPU': workers + 1,
+            'Mem': int(math.ceil(memory / 256) * 256),
+            'ukf_workers': workers,
+            'rounds': -(-n_points // workers)}
+
+
+#%% main
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--config', default='iot_config.json')
+    parser.add_argument('--fmu', default='./assets/web_line_3_linux.fmu',
+                        help='override the fmu_file entry of the config')
+    parser.add_argument('--rounds', type=int, default=1,
+                        help='pool dispatches per ukf step the profile allows')
+    parser.add_argument('--write', default=None,
+                        help='file for the profile, e.g. compute_profile.json')
+    args = parser.parse_args()
+
+    if not os.path.isfile(args.config):
+        sys.exit(f"ERROR: couldnt find {args.config} "
+                 +"try running this file one directory higher.")
+    with open(args.config,'r') as f:
+        config = json.load(f)
+    config['fmu_file'] = os.path.abspath(args.fmu)
+
+    n_points = n_sigma_points(config)
+    worker_mb = measure_worker_memory(config)
+    base_mb = peak_rss_mb()
+    profile = recommend_profile(n_points, worker_mb, base_mb, rounds=args.rounds)
+    print(f"{n_points} fmu runs per step, {worker_mb:.0f} MB per fmu worker, "
+          +f"{base_mb:.0f} MB main process")
+    print(f"recommended: {profile['vCPU']} vCPU, {profile['Mem']} MB "
+          +f"({profile['ukf_workers']} workers, {profile['rounds']} rounds per step), "
+          +f"configured: {config['vCPU']} vCPU, {config['Mem']} MB")
+
+    if args.write is not None:
+        with open(args.write, 'w') as f:
+            json.dump(profile, f, indent=4)
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+######################################################################
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved. #
+# SPDX-License-Identifier: MIT-0                                     #
+######################################################################
+
+#generic packages
+import os
+import json
+import atexit
+import hashlib
+import tempfile
+import multiprocessing.util
+import numpy as np
+import pandas
+from collections import OrderedDict
+
+#awswrangler is imported on first use of an S3 bucket, it is slow to import
+
+#config fields that change the fmu result for the same inputs, the stepping
+#mode and the warm start (snapshot choice, steady-state exit) included
+result_fields = ['fmu_step_size', 'fmu_stop_time', 'fmu_ss_iterations', 'fmu_ss_tolerance',
+                 'fmu_adaptive_step', 'fmu_max_step_size', 'fmu_ss_window',
+                 'fmu_warm_start', 'fmu_warm_start_snapshots', 'fmu_instance_pool']
+
+#one cache per (process, config key)
+_caches = {}
+_file_hashes = {}
+
+
+def file_hash(filename:str) -> str:
+    filename = os.path.abspath(filename)
+    if filename not in _file_hashes:
+        sha = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                sha.update(block)
+        _file_hashes[filename] = sha.hexdigest()
+    return _file_hashes[filename]
+
+
+class FMUResultCache(object):
+    '''
+    Content addressed cache of FMU results. Keys hash the FMU file, the
+    config fields that change results and the input vector quantized to
+    `quantum`. Lookups go through an in-memory LRU, then an optional local
+    folder shared by the processes on a host, then an optional S3 prefix
+    shared across batch jobs.
+
+    :param config: iot_config, only fmu_file, the input/result names and
+                   the fields in result_fields are used
+    :param max_entries: size of the in-memory LRU
+    :param quantum: inputs closer than this share a result
+    :param cache_dir: local folder tier, None disables
+    :param max_local_bytes: size limit of the local folder, the least
+                            recently used files are removed above it
+    :param s3_bucket: S3 tier, None disables
+    '''
+    def __init__(self, config:dict, max_entries:int=4096, quantum:float=1e-9,
+                 cache_dir:str=None, s3_bucket:str=None, s3_prefix:str='fmu_cache',
+                 max_local_bytes:int=32 << 20):
+        self.max_entries = max_entries
+        self.quantum = quantum
+        self.cache_dir = cache_dir
+        self.max_local_bytes = max_local_bytes
+        #bytes this process wrote since it last checked the folder size
+        self.written_bytes = 0
+        self.s3_bucket = s3_bucket
+        self.s3_prefix = s3_prefix
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+        fields = {key: config[key] for key in result_fields if key in config}
+        #the measured outputs decide when the run is steady
+        fields['names'] = [value for key, value in config.items()
+                           if 'input' in key or 'result' in key or 'measured' in key]
+        self.prefix = file_hash(config['fmu_file']) \
+                      + json.dumps(fields, sort_keys=True)
+
+        self.lru = OrderedDict()
+        self.stats = {'hits_memory': 0, 'hits_local': 0, 'hits_s3': 0, 'misses': 0}
+
+    def key(self, inputs:np.array) -> str:
+        quantized = np.round(np.asarray(inputs, dtype='float64') / self.quantum).astype('int64')
+        return hashlib.sha256(self.prefix.encode() + quantized.tobytes()).hexdigest()
+
+    def _remember(self, key:str, df:pandas.DataFrame):
+        self.lru[key] = df
+        self.lru.move_to_end(key)
+        while len(self.lru) > self.max_entries:
+            self.lru.popitem(last=False)
+
+    def _read(self, filename:str) -> pandas.DataFrame:
+        arr = np.load(filename)
+        return pandas.DataFrame([arr['values']], columns=arr['names'].tolist())
+
+    def get(self, inputs:np.array) -> pandas.DataFrame:
+        key = self.key(inputs)
+        if key in self.lru:
+            self.lru.move_to_end(key)
+            self.stats['hits_memory'] += 1
+            return self.lru[key]
+
+        if self.cache_dir is not None:
+            local_file = os.path.join(self.cache_dir, key + '.npz')
+            try:
+                df = self._read(local_file)
+                #the modification time orders the files for eviction
+                os.utime(local_file)
+            except (OSError, ValueError):
+                #missing, or evicted by another process meanwhile
+                df = None
+            if df is not None:
+                self._remember(key, df)
+                self.stats['hits_local'] += 1
+                return df
+
+        if self.s3_bucket is not None:
+            from awswrangler.s3 import does_object_exist, download
+            path = f's3://{self.s3_bucket}/{self.s3_prefix}/{key}.npz'
+            if does_object_exist(path):
+                with tempfile.TemporaryDirectory() as tmp:
+                    local_file = os.path.join(tmp, key + '.npz')
+                    download(path=path, local_file=local_file)
+                    df = self._read(local_file)
+                self._remember(key, df)
+                self.stats['hits_s3'] += 1
+                return df
+
+        self.stats['misses'] += 1
+        return None
+
+    def put(self, inputs:np.array, df:pandas.DataFrame):
+        key = self.key(inputs)
+        self._remember(key, df)
+        if self.cache_dir is None and self.s3_bucket is None:
+            return
+
+        if self.s3_bucket is not None:
+            from awswrangler.s3 import upload
+        names = np.array(df.columns.tolist())
+        values = df.iloc[0].to_numpy(dtype='float64')
+        s3_path = f's3://{self.s3_bucket}/{self.s3_prefix}/{key}.npz'
+        if self.cache_dir is not None:
+            local_file = os.path.join(self.cache_dir, key + '.npz')
+            #rename is atomic, concurrent readers never see partial files
+            tmp_file = os.path.join(self.cache_dir, f'{key}.{os.getpid()}.tmp.npz')
+            try:
+                np.savez(tmp_file, names=names, values=values)
+                os.replace(tmp_file, local_file)
+                self.written_bytes += os.path.getsize(local_file)
+            except OSError:
+                #e.g. a full /dev/shm, the result is still returned
+                if os.path.exists(tmp_file):
+                    os.remove(tmp_file)
+                self.evict(self.max_local_bytes // 2)
+            if self.written_bytes > self.max_local_bytes // 10:
+                self.evict()
+            if self.s3_bucket is not None and os.path.isfile(local_file):
+                upload(local_file=local_file, path=s3_path)
+        else:
+            with tempfile.TemporaryDirectory() as tmp:
+                local_file = os.path.join(tmp, key + '.npz')
+                np.savez(local_file, names=names, values=values)
+                upload(local_file=local_file, path=s3_path)
+
+    def evict(self, target_bytes:int=None):
+        '''
+        Remove the least recently used files of the local folder until it is
+        below target_bytes. With None only a folder above max_local_bytes is
+        cut down, to 80% of it. The folder is shared by the processes of a
+        host, each checks it after writing a tenth of the limit.
+        '''
+        self.written_bytes = 0
+        limit = self.max_local_bytes if target_bytes is None else target_bytes
+        if target_bytes is None:
+            target_bytes = int(0.8 * self.max_local_bytes)
+        files = []
+        for entry in os.scandir(self.cache_dir):
+            try:
+                if entry.name.endswith('.npz') and '.tmp.' not in entry.name:
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, stat.st_size, entry.path))
+            except FileNotFoundError:
+                continue
+        total = sum(size for _, size, _ in files)
+        if total <= limit:
+            return
+        for _, size, path in sorted(files):
+            if total <= target_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def get_cache(config:dict) -> FMUResultCache:
+    '''
+    Return the result cache of the calling process for this config.
+    '''
+    key = (os.getpid(), os.path.abspath(config['fmu_file']))
+    if key not in _caches:
+        if multiprocessing.parent_process() is not None \
+                and not any(pid == os.getpid() for pid, _ in _caches):
+            #pool workers exit without running atexit handlers
+            multiprocessing.util.Finalize(None, report_cache_stats, exitpriority=10)
+        _caches[key] = FMUResultCache(config,
+                            max_entries = config.get('fmu_cache_entries', 4096),
+                            quantum = config.get('fmu_cache_quantum', 1e-9),
+                            cache_dir = config.get('fmu_cache_dir'),
+                            s3_bucket = config.get('fmu_cache_s3_bucket'),
+                            max_local_bytes = int(config.get('fmu_cache_local_mb', 32) * (1 << 20)))
+    return _caches[key]
+
+
+def run_cached_fmu(inputs:np.array, config:dict, run) -> pandas.DataFrame:
+    '''
+    Return the cached result for these inputs or evaluate run(inputs, config)
+    and cache it.
+    '''
+    cache = get_cache(config)
+    df = cache.get(inputs)
+    if df is None:
+        df = run(inputs, config)
+        cache.put(inputs, df)
+    return df
+
+
+def get_cache_stats() -> dict:
+    '''
+    Hit/miss counters summed over the caches of this process.
+    '''
+    stats = {'hits_memory': 0, 'hits_local': 0, 'hits_s3': 0, 'misses': 0}
+    for (pid, _), cache in _caches.items():
+        if pid == os.getpid():
+            for key, value in cache.stats.items():
+                stats[key] += value
+    return stats
+
+
+@atexit.register
+def report_cache_stats():
+    stats = get_cache_stats()
+    if sum(stats.values()) > 0:
+        print(f"fmu cache (pid {os.getpid()}): {stats['hits_memory']} memory, "
+              +f"{stats['hits_local']} local, {stats['hits_s3']} s3 hits, "
+              +f"{stats['misses']} misses")
@@ -6,75 +6,162 @@
 
 
 #generic packages
+import time
+#startup profile, see --profile-startup
+_startup = {'module_start': time.perf_counter()}
+import os
+import signal
+import traceback
+import threading
 import pandas
 from functools import reduce
 import numpy as np
-import random
 import copy
 from tqdm import tqdm
 from datetime import datetime
+from contextlib import nullcontext
+
+#twinmodule packages, run_fmu and the single property sitewise calls are
+#only imported by the paths that use them
+from twinmodules.core.util import get_user_json_config
+
+#twinstat is only imported by the twinstat_ukf filter
+
+#local packages
+from fmu_pool import run_pooled_fmu, init_worker, get_fmu_instance
+from calibration_engine import StreamingUKF, SquareRootUKF, EnsembleKF
+from calibration_engine import localization_matrix
+from fmu_cache import run_cached_fmu
+from savepoint import CalibrationSavepoint, SavepointLease
+from sitewise_io import get_property_ids, get_properties_history, align_streams
+from sitewise_io import load_cursor, store_cursor, SiteWiseBatchWriter
+from sitewise_io import get_calibration_assets, get_asset_id, asset_logical_id
+from metrics import configure, span, timer, count, emit
+from stack_metadata import get_stack_resources
 
-#awswrangler packages
-from awswrangler.s3 import does_object_exist, upload, download
+#global variables
+ukf_savepoint = 'ukf_savepoint.npz'
+_startup['imports'] = time.perf_counter()
 
-#twinmodule packages
-from twinmodules.core.components import run_fmu
-from twinmodules.core.util import get_user_json_config, get_cloudformation_metadata
-from twinmodules.AWSModules.AWS_sitewise import get_asset_property_data
-from twinmodules.AWSModules.AWS_sitewise import send_asset_property_data
 
-#twinstat packages
-from twinstat.statespace_models.estimators import kalman
+def savepoint_prefix(config, asset_index=0):
+    #a single asset keeps the original savepoint location, with several
+    #assets every one gets its own folder
+    assets = get_calibration_assets(config)
+    if len(assets) == 1:
+        return ''
+    return assets[asset_index] + '/'
 
-#global variables
-ukf_savepoint = 'ukf_savepoint.npz'
 
+def get_savepoint(config, metadata, asset_index=0, load=True):
+    #without a data lake bucket (local runs) the savepoint stays local
+    s3_bucket = next((value for key, value in metadata.items() if 'datalake' in key), None)
+    prefix = savepoint_prefix(config, asset_index)
+    savepoint = CalibrationSavepoint(s3_bucket, prefix + ukf_savepoint,
+                    history_prefix = prefix + 'ukf_history',
+                    retention = config.get('savepoint_history_segments', 1440),
+                    local_dir = config.get('savepoint_local_dir', '.'))
+    if load:
+        with span('savepoint_load'):
+            savepoint.load()
+    return savepoint
 
-def get_data(config, metadata):
-    sitewise_names = [value for key, value in config.items() if 'measured' in key]
-    assetId = metadata['MyCfnAsset']
 
-    sitewise_data = []
-    for name in sitewise_names:
-        tmp = get_asset_property_data(  name,
-                                        assetId,
-                                        maxResults=15
+def get_data(config, metadata, savepoint=None, client=None, asset_index=0):
+    sitewise_names = [value for key, value in config.items() if 'measured' in key]
+    assetId = get_asset_id(config, metadata, asset_index)
+
+    #without a savepoint there is no cursor, just take the latest values
+    incremental = savepoint is not None and config.get('sitewise_incremental', True)
+    if incremental:
+        #only points newer than the last processed one, all properties are
+        #fetched concurrently and aligned in a single pass
+        cursor = load_cursor(savepoint)
+        property_ids = get_property_ids(assetId, client)
+        frames = get_properties_history(assetId,
+                                        {name: property_ids[name] for name in sitewise_names},
+                                        cursor,
+                                        latest = config.get('sitewise_initial_points', 15),
+                                        max_workers = config.get('sitewise_max_workers', 16),
+                                        client = client
                                         )
-        tmp.columns = [x  if 'time' in x else name  for x in tmp.columns]
-        sitewise_data.append(tmp)
-
-    #merge all streams into one dataframe, ensure timesteps alligned
-    dfsw = reduce(lambda  left,right: pandas.merge(left,right,on=['time'],
-                                            how='outer'), sitewise_data)
-    dfsw = dfsw.dropna()
+        dfsw = align_streams(frames,
+                             tolerance = config.get('sitewise_align_tolerance', 0.0))
+    else:
+        from twinmodules.AWSModules.AWS_sitewise import get_asset_property_data
+        sitewise_data = []
+        for name in sitewise_names:
+            tmp = get_asset_property_data(  name,
+                                            assetId,
+                                            maxResults=15
+                                            )
+            tmp.columns = [x  if 'time' in x else name  for x in tmp.columns]
+            sitewise_data.append(tmp)
+
+        #merge all streams into one dataframe, ensure timesteps alligned
+        dfsw = reduce(lambda  left,right: pandas.merge(left,right,on=['time'],
+                                                how='outer'), sitewise_data)
+        dfsw = dfsw.dropna()
+
+    if incremental and dfsw.shape[0] > 0:
+        #points newer than the last aligned row may still get partners, so
+        #they are fetched again next run. The cursor is persisted when the
+        #calibration is saved.
+        last_time = float(dfsw['time'].iloc[-1])
+        store_cursor(savepoint, {name: last_time for name in sitewise_names})
     return dfsw
 
 
 
+def run_twinmodules_fmu(damping_coefficients, config):
+    from twinmodules.core.components import run_fmu
+    local_config = copy.deepcopy(config)
+    #one id per process instead of a random one per run, so the scratch
+    #files twinmodules names after it are overwritten instead of piling up
+    local_config['uid'] = os.getpid()
+    local_config['fmu_file'] = os.path.abspath(config['fmu_file'])
+    count('fmu_runs')
+    with timer('fmu_run_seconds'):
+        return run_fmu(damping_coefficients, local_config,'dummy', 0, use_cloud=False)
+
+
+def evaluate_fmu(damping_coefficients, config):
+    if config.get('fmu_instance_pool', True):
+        #reuse the fmu already loaded in this worker process
+        run = run_pooled_fmu
+    else:
+        run = run_twinmodules_fmu
+    if config.get('fmu_cache', False):
+        #identical (quantized) damping coefficients are only simulated once
+        return run_cached_fmu(damping_coefficients, config, run)
+    return run(damping_coefficients, config)
+
+
+
 class my_transition_function(object):
     def __init__(self, config:dict,
                  measured: list,
                  n_inputs:int,
                  extra_inferred:list[str]=None,
-                 run_local:bool = False):
+                 run_local:bool = False,
+                 output_names:list[str]=None):
         self.config = config
         self.run_local = run_local
         self.measured = measured
         self.n_inputs = n_inputs
         self.n_measured = len(measured)
         self.extra_inferred = extra_inferred
+        #fmu outputs appended after the state for the prediction bands
+        self.output_names = output_names
 
     def run_my_fmu(self,X:np.array) -> np.array:
 
-        local_config = copy.deepcopy(self.config)
-        local_config['uid'] = random.getrandbits(24)
-
         #last 9 are the inferred damping
         damping_coefficients = X[self.n_measured:self.n_measured+self.n_inputs]
         #negative is non-physical
         damping_coefficients = np.clip(damping_coefficients, 0,0.5)
         #evaluate the digital twin
-        df = run_fmu(damping_coefficients, local_config,'dummy', 0, use_cloud=False)
+        df = evaluate_fmu(damping_coefficients, self.config)
 
         #return the next state space vector in which the first group are the
         #digital twin predicted slip velocities and the last group are the xt-1
@@ -91,14 +178,22 @@ class my_transition_function(object):
             Xt = np.concatenate((predicted_slip_velocities, damping_coefficients, predicted_tensions))
         else:
             Xt = np.concatenate((predicted_slip_velocities, damping_coefficients))
+        if self.output_names is not None:
+            Xt = np.concatenate((Xt, df[self.output_names].to_numpy(dtype='float64')[0]))
         return Xt
 
 #------------------------------------------------------------------------------------------
 
-def calibrate(dfsw, config, metadata):
-
+def calibrate(dfsw, config, metadata, savepoint=None, asset_index=0,
+              filters=None, save=True):
+    '''
+    Filter the rows of dfsw and store the calibrated state in the savepoint.
 
-    s3_bucket = [value for key, value in metadata.items() if 'datalake' in key][0]
+    A long-running caller passes the same filters dictionary to every call,
+    the filter with its worker pool and loaded FMUs is then kept alive
+    between calls instead of being rebuilt. With save=False the savepoint
+    is only updated in memory and the caller uploads it.
+    '''
 
     #check if any ukf savepoints exist
     calibrated_mean = []
@@ -150,121 +245,517 @@ def calibrate(dfsw, config, metadata):
     #ukf to ensure easier convergence and design of covariance matrix
     norm = [1.0e3 if 'Tension' in col else 1 for col in measured ]
 
-    if does_object_exist(f's3://{s3_bucket}/{ukf_savepoint}'):
-        download(path=f's3://{s3_bucket}/{ukf_savepoint}',
-                 local_file = f'./{ukf_savepoint}')
-        arr = np.load(ukf_savepoint)
-        calibrated_mean = arr['calibrated_mean']
-        calibrated_var = arr['calibrated_var']
+    #only the latest filter state is downloaded, the history is kept in
+    #a ring buffer of per-run segments next to it
+    if savepoint is None:
+        savepoint = get_savepoint(config, metadata, asset_index)
+    if 'mean' in savepoint.data:
+        calibrated_mean = [savepoint.data['mean']]
+        calibrated_var = [savepoint.data['covariance']]
 
-        calibrated_mean = calibrated_mean.tolist()
-        calibrated_var = calibrated_var.tolist()
-
-    #run ukf to calibrate the fmu
-    nsteps = dfsw.shape[0]
-    for i in tqdm(range(nsteps)):
-        #i=0
-
-        y = dfsw[measured].to_numpy()[i]
-        y/=norm
-        y = np.array([y,y])
-
-        ukf = kalman('ukf', y,
-                     initial_state = np.array(calibrated_mean[-1]),
-                     initial_state_covariance = np.array(calibrated_var[-1]),
-                     transition_matrix=transition_matrix,
-                     measurement_noise=measurement_noise,
-                     process_covariance =process_noise,
-                     ncpu= -1, #use all available
-                     use_threads=False
-                     )
-
-        # we are setting the state function to be the fmu calculation
-        # we are not going to change the observation function since it will
-        # be the identity matrix by default
-        ukf.state_func = tf.run_my_fmu
-        xhat,xvar = ukf.get_estimate(y)
-
-        updates = xhat[-1]
+    def clip_damping(mean):
         #during initial unconverged solutions could possibly diverge, so add
         #in a bounding clip for this scenario
-        updates[n_measured:n_measured+n_damping] = np.clip(
-                            updates[n_measured:n_measured+n_damping], 0,0.5
+        mean[n_measured:n_measured+n_damping] = np.clip(
+                            mean[n_measured:n_measured+n_damping], 0,0.5
                             )
-        calibrated_mean.append(updates)
-        calibrated_var.append(xvar[-1])
-
-    #save updated calibration
-    np.savez(ukf_savepoint,
-            calibrated_mean=calibrated_mean,
-            calibrated_var=calibrated_var
-            )
+        return mean
 
-    #upload calibration
-    upload(local_file = f'./{ukf_savepoint}',
-           path= f's3://{s3_bucket}/{ukf_savepoint}')
+    #run ukf to calibrate the fmu
+    nsteps = dfsw.shape[0]
+    Y = dfsw[measured].to_numpy() / norm
+
+    #calibrated_mean[recorded:] still has to be added to the savepoint history
+    recorded = 1
+    def record():
+        nonlocal recorded
+        for mean, var in zip(calibrated_mean[recorded:], calibrated_var[recorded:]):
+            savepoint.step(mean=mean, covariance=var)
+        recorded = len(calibrated_mean)
+
+    if config.get('calibration_filter', 'ukf') == 'twinstat_ukf':
+        #the legacy filter has no sigma point outputs, make_prediction runs
+        #the fmu at the mean instead
+        for key in ['prediction_names', 'prediction_mean', 'prediction_variance']:
+            savepoint.data.pop(key, None)
+        #legacy path, rebuilds the twinstat filter and its pool for every row
+        from twinstat.statespace_models.estimators import kalman
+        for i in tqdm(range(nsteps)):
+            y = np.array([Y[i],Y[i]])
+
+            ukf = kalman('ukf', y,
+                         initial_state = np.array(calibrated_mean[-1]),
+                         initial_state_covariance = np.array(calibrated_var[-1]),
+                         transition_matrix=transition_matrix,
+                         measurement_noise=measurement_noise,
+                         process_covariance =process_noise,
+                         ncpu= -1, #use all available
+                         use_threads=False
+                         )
+
+            # we are setting the state function to be the fmu calculation
+            # we are not going to change the observation function since it will
+            # be the identity matrix by default
+            ukf.state_func = tf.run_my_fmu
+            xhat,xvar = ukf.get_estimate(y)
+
+            calibrated_mean.append(clip_damping(xhat[-1]))
+            calibrated_var.append(xvar[-1])
+    else:
+        surrogate = None
+        if config.get('fmu_surrogate', False):
+            #fast regression of the fmu on the damping coefficients, the fmu
+            #is only run where its error estimate exceeds the tolerance, a
+            #fraction of the measurement std and of the sigma point spread
+            from fmu_surrogate import PolynomialSurrogate
+            surrogate_fraction = config.get('surrogate_tolerance', 0.1)
+            surrogate = PolynomialSurrogate(slice(n_measured, n_measured+n_damping),
+                            tolerance = surrogate_fraction * np.sqrt(np.diag(measurement_noise)),
+                            spread_fraction = surrogate_fraction,
+                            max_samples = config.get('surrogate_max_samples', 370),
+                            verify_every = config.get('surrogate_verify_every', 50))
+
+        #catch-up runs with many rows checkpoint their progress, the cursor
+        #then only covers the rows already filtered
+        final_cursor = load_cursor(savepoint)
+        checkpoint_rows = config.get('savepoint_checkpoint_rows', 0)
+        last_checkpoint = 0
+        def background():
+            #runs while the pool evaluates the next sigma points
+            nonlocal last_checkpoint
+            record()
+            done = recorded - 1
+            if checkpoint_rows > 0 and len(final_cursor) > 0 \
+                    and done - last_checkpoint >= checkpoint_rows:
+                store_cursor(savepoint, {name: float(dfsw['time'].iloc[done-1])
+                                         for name in final_cursor})
+                savepoint.data.update(ukf.savepoint_arrays())
+                with span('savepoint_save', checkpoint=True):
+                    savepoint.save()
+                last_checkpoint = done
+
+        #rows filtered per dispatch of sigma points, see StreamingUKF.step_block
+        lag = max(int(config.get('ukf_fixed_lag', 1)), 1)
+
+        filter_class = StreamingUKF
+        filter_options = {}
+        if config.get('calibration_filter', 'ukf') == 'sr_ukf':
+            #carry the cholesky factor instead of the covariance
+            filter_class = SquareRootUKF
+            root = savepoint.data.get('covariance_root')
+            #a factor left over from an earlier sr_ukf run may be stale
+            if root is not None and np.allclose(root @ root.T, calibrated_var[-1],
+                                                rtol=1e-6, atol=1e-20):
+                filter_options['initial_root'] = root
+        elif config.get('calibration_filter', 'ukf') == 'enkf':
+            #fixed number of fmu runs per step, independent of the state size
+            filter_class = EnsembleKF
+            filter_options = {'ensemble_size': config.get('enkf_ensemble_size', 24),
+                              'seed': config.get('enkf_seed')}
+            ensemble = savepoint.data.get('ensemble')
+            if ensemble is not None and np.allclose(ensemble.mean(axis=0), calibrated_mean[-1]):
+                filter_options['initial_ensemble'] = ensemble
+            radius = config.get('enkf_localization_radius', 0)
+            if radius > 0:
+                #measured and damping states of a roller share its position
+                positions = np.concatenate((np.arange(n_measured), np.arange(n_damping)))
+                filter_options['localization'] = localization_matrix(positions, radius)
+
+        #the sigma point runs also return every result channel, so the last
+        #step gives the prediction and its bands at the updated state without
+        #another fmu run
+        result_names = [value for key, value in config.items() if 'result' in key]
+        tf.output_names = result_names
+
+        ukf = None if filters is None else filters.get(filter_class.__name__)
+        if ukf is not None:
+            #kept alive by the caller, its state is the savepoint state
+            surrogate = ukf.surrogate
+        else:
+            # one filter and one worker pool for all rows, each worker loads the
+            # fmu once. The state function is the fmu calculation and the
+            # observation picks out the measured states.
+            with span('ukf_setup', filter=filter_class.__name__):
+                ukf = filter_class(tf.run_my_fmu,
+                                   initial_state = np.array(calibrated_mean[-1]),
+                                   initial_state_covariance = np.array(calibrated_var[-1]),
+                                   measurement_noise = measurement_noise[:n_measured,:n_measured],
+                                   process_noise = process_noise,
+                                   n_observed = n_measured,
+                                   constrain = clip_damping,
+                                   alpha = config.get('ukf_alpha', 1.0),
+                                   beta = config.get('ukf_beta', 2.0),
+                                   kappa = config.get('ukf_kappa', 0.0),
+                                   ncpu = config.get('ukf_ncpu', -1),
+                                   initializer = init_worker,
+                                   initargs = (config,),
+                                   surrogate = surrogate,
+                                   gate_threshold = config.get('ukf_gate_threshold') or None,
+                                   gate_max_skips = config.get('ukf_gate_max_skips', 0),
+                                   **filter_options
+                                   )
+            if filters is not None:
+                filters[filter_class.__name__] = ukf
+        evaluations, gated = ukf.n_evaluations, ukf.n_gated
+        #a filter kept by the caller also keeps its worker pool open
+        with (ukf if filters is None else nullcontext()), tqdm(total=nsteps) as progress:
+            for i in range(0, nsteps, lag):
+                with timer('ukf_step_seconds'):
+                    if lag == 1:
+                        xhat, xvar = ukf.step(Y[i], background)
+                        calibrated_mean.append(xhat.copy())
+                        calibrated_var.append(xvar.copy())
+                    else:
+                        xhat, xvar = ukf.step_block(Y[i:i+lag], background)
+                        calibrated_mean.extend(xhat)
+                        calibrated_var.extend(xvar)
+                count('ukf_rows', min(lag, nsteps - i))
+                progress.update(min(lag, nsteps - i))
+        count('state_evaluations', ukf.n_evaluations - evaluations)
+        count('ukf_gated_rows', ukf.n_gated - gated)
+
+        if len(final_cursor) > 0:
+            store_cursor(savepoint, final_cursor)
+        savepoint.data.update(ukf.savepoint_arrays())
+        moments = ukf.output_moments()
+        if moments is not None:
+            savepoint.data.update(prediction_names=np.array(result_names),
+                                  prediction_mean=moments[0],
+                                  prediction_variance=moments[1])
+        else:
+            #no full sigma point outputs this run (surrogate points or all
+            #rows gated), an older prediction must not be published as
+            #current, make_prediction runs the fmu at the mean instead
+            for key in ['prediction_names', 'prediction_mean', 'prediction_variance']:
+                savepoint.data.pop(key, None)
 
+        if surrogate is not None:
+            print(f"fmu surrogate: {surrogate.n_predicted} sigma points predicted, "
+                  +f"{surrogate.n_evaluated} evaluated with the fmu")
 
-#------------------------------------------------------------------------------------------
-def make_prediction(dfsw, config, metadata):
+    #save and upload updated calibration
+    savepoint.data.update(mean=calibrated_mean[-1], covariance=calibrated_var[-1])
+    record()
+    if save:
+        with span('savepoint_save', checkpoint=False):
+            savepoint.save()
 
-    arr = np.load(ukf_savepoint)
-    calibrated_mean = arr['calibrated_mean']
-    calibrated_var = arr['calibrated_var']
 
-    assetId = metadata['MyCfnAsset']
+#------------------------------------------------------------------------------------------
+def make_prediction(dfsw, config, metadata, client=None, asset_index=0,
+                    savepoint=None):
+
+    #the in-memory state of a long-running caller may not be saved yet
+    if savepoint is not None:
+        arr = savepoint.data
+    else:
+        arr = np.load(savepoint_prefix(config, asset_index) + ukf_savepoint)
+    calibrated_mean = arr['mean']
+    calibrated_var = arr['covariance']
+
+    assetId = get_asset_id(config, metadata, asset_index)
     sitewise_names = [value for key, value in config.items() if 'result' in key or 'input' in key]
+    input_names = [value for key, value in config.items() if 'input' in key]
     uncertainty_names = [value for key, value in config.items() if 'uncertainty' in key.lower()]
 
-    damping_coefficients = calibrated_mean[-1][-9:]
-    damping_coefficients_std = np.sqrt(np.diag(calibrated_var[-1])[-9:])
+    damping_coefficients = calibrated_mean[-9:]
+    damping_coefficients_std = np.sqrt(np.diag(calibrated_var)[-9:])
 
     dt = datetime.today()
     now = dt.timestamp()
 
-    df = run_fmu(damping_coefficients, config,'dummy', 0, use_cloud=False)
-    fmu_names = df.columns
-
-    for sitewise_name in fmu_names:
+    #the damping coefficients are the calibrated state itself
+    predicted = dict(zip(input_names, damping_coefficients))
+    predicted_std = dict(zip(input_names, damping_coefficients_std))
+    if 'prediction_mean' in arr:
+        #mean and spread of every result channel at the calibrated state,
+        #from the sigma point runs of the last ukf step
+        result_names = arr['prediction_names'].tolist()
+        predicted.update(zip(result_names, arr['prediction_mean']))
+        predicted_std.update(zip(result_names, np.sqrt(arr['prediction_variance'])))
+        print("prediction uses the sigma point runs of the last ukf step")
+    else:
+        with span('prediction_fmu'):
+            df = evaluate_fmu(damping_coefficients, config)
+        predicted.update({name: df[name].iloc[0] for name in df.columns
+                          if name not in predicted})
+
+    #collect every value to push, including the uncertainty bands
+    outputs = {}
+    for sitewise_name, value in predicted.items():
         if sitewise_name not in sitewise_names:
             continue
-        data = df[sitewise_name]
         #need to makesure we stick with sitewise schema
-        data = data.astype('float64')
-        t = [0.0]
-
-        data=data.to_numpy()
+        data = np.array([value], dtype='float64')
         print(sitewise_name, data)
+        outputs[sitewise_name] = data
 
-        send_asset_property_data( sitewise_name,
-                                  t,
-                                  data,
-                                  assetId=assetId,
-                                  use_current_time=False,
-                                  use_time=now
-                                  )
-
-        if sitewise_name in uncertainty_names:
-            idx = uncertainty_names.index(sitewise_name)
-            data_std = data + damping_coefficients_std[idx]
+        if sitewise_name in uncertainty_names and sitewise_name in predicted_std:
+            std = predicted_std[sitewise_name]
             #upper bound uncertainty
-            send_asset_property_data( sitewise_name+'_upper',
-                                      t,
-                                      data_std,
-                                      assetId=assetId,
-                                      use_current_time=False,
-                                      use_time=now
-                                      )
-
-            data_std = data - damping_coefficients_std[idx]
+            outputs[sitewise_name+'_upper'] = data + std
             #lower bound uncertainty
-            send_asset_property_data( sitewise_name+'_lower',
-                                      t,
-                                      data_std,
-                                      assetId=assetId,
-                                      use_current_time=False,
-                                      use_time=now
-                                      )
+            outputs[sitewise_name+'_lower'] = data - std
+
+    if config.get('sitewise_batch_writes', True):
+        #pack everything into as few BatchPutAssetPropertyValue calls as
+        #possible and send them concurrently
+        with span('sitewise_write', values=len(outputs)):
+            property_ids = get_property_ids(assetId, client)
+            with SiteWiseBatchWriter(assetId, property_ids, client,
+                        max_workers = config.get('sitewise_max_workers', 16)
+                        ) as writer:
+                stats = writer.send({name: ([now], data) for name, data in outputs.items()})
+        count('sitewise_write_requests', len(stats))
+        count('sitewise_write_retries', sum(batch['retries'] for batch in stats))
+        for i, batch in enumerate(stats):
+            print(f"sitewise batch {i}: {batch['entries']} entries, "
+                  +f"{batch['latency']*1e3:.1f} ms, {batch['retries']} retries")
+    else:
+        from twinmodules.AWSModules.AWS_sitewise import send_asset_property_data
+        t = [0.0]
+        with span('sitewise_write', values=len(outputs)):
+            for sitewise_name, data in outputs.items():
+                send_asset_property_data( sitewise_name,
+                                          t,
+                                          data,
+                                          assetId=assetId,
+                                          use_current_time=False,
+                                          use_time=now
+                                          )
+
+
+
+def process_age():
+    #seconds since this process started, None where /proc is not available
+    try:
+        with open('/proc/self/stat', 'r') as f:
+            start_ticks = float(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime', 'r') as f:
+            uptime = float(f.read().split()[0])
+        return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def profile_startup(config, asset_index=0, metadata=None):
+    '''
+    Time the work every run does before filtering the first row, print a
+    report and write it as one metrics record.
+    '''
+    now = time.perf_counter()
+    age = process_age()
+    phases = {}
+    if age is not None:
+        phases['interpreter'] = age - (now - _startup['module_start'])
+    phases['imports'] = _startup['imports'] - _startup['module_start']
+
+    t0 = time.perf_counter()
+    if metadata is None:
+        metadata = get_stack_resources('FMUCalibrationStack', region='us-east-1')
+    phases['stack_metadata'] = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    get_savepoint(config, metadata, asset_index)
+    phases['savepoint_load'] = time.perf_counter() - t0
+
+    #paid once in every worker process
+    t0 = time.perf_counter()
+    get_fmu_instance(config)
+    phases['fmu_load'] = time.perf_counter() - t0
+
+    total = sum(phases.values())
+    print("startup profile:")
+    for name, seconds in phases.items():
+        print(f"{name:>16s}: {seconds:7.3f} s {100*seconds/total:5.1f} %")
+    print(f"{'total':>16s}: {total:7.3f} s")
+    emit(dict(startup=phases, seconds=total), units={'seconds': 'Seconds'})
+    return phases
+
+
+class CalibrationService(object):
+    '''
+    Long-running alternative to one batch job per schedule tick. The stack
+    metadata, the savepoint and the filter with its worker pool and loaded
+    FMUs stay in memory while new SiteWise points are polled every
+    poll_seconds and filtered as they arrive. The savepoint is uploaded
+    every checkpoint_seconds and on shutdown instead of after every poll,
+    after a crash the points since the last checkpoint are filtered again.
+
+    The scheduled jobs can overlap (queue and scale-up delays, slow startup),
+    so with a lease the service first waits until it holds the lease on the
+    savepoint, only then loads the savepoint, and stops without saving as
+    soon as a renewal shows that another job took the lease over.
+
+    :param savepoint: savepoint, see get_savepoint, loaded by run() if a
+                      lease is given
+    :param client: SiteWise client, e.g. local_stubs.LocalSiteWiseClient,
+                   the boto3 client if None
+    :param lease: savepoint.SavepointLease, None runs without one
+    '''
+    def __init__(self, config, metadata, savepoint, client=None, asset_index=0,
+                 lease=None):
+        self.config = config
+        self.metadata = metadata
+        self.savepoint = savepoint
+        self.client = client
+        self.asset_index = asset_index
+        self.lease = lease
+        self.poll_seconds = config.get('service_poll_seconds', 5)
+        self.checkpoint_seconds = config.get('service_checkpoint_seconds', 60)
+        self.max_backoff_seconds = config.get('service_max_backoff_seconds', 300)
+        self.filters = {}
+        self.stopping = threading.Event()
+        self.last_checkpoint = time.monotonic()
+        self.n_polls = 0
+        self.n_rows = 0
+        #set while the filter is ahead of the savepoint of a failed poll
+        self.dirty = False
+
+    def stop(self, *args):
+        #signal handler, the current poll finishes before the service exits
+        self.stopping.set()
+
+    def poll(self) -> int:
+        '''
+        Filter the points that arrived since the last poll and push the
+        prediction, returns the number of rows filtered.
+        '''
+        with span('get_data'):
+            dfsw = get_data(self.config, self.metadata, self.savepoint,
+                            self.client, self.asset_index)
+        count('sitewise_rows', dfsw.shape[0])
+        self.n_polls += 1
+        if dfsw.shape[0] == 0:
+            return 0
+        self.dirty = True
+        with span('calibrate', rows=dfsw.shape[0]):
+            calibrate(dfsw, self.config, self.metadata, self.savepoint, self.asset_index,
+                      filters=self.filters, save=False)
+        self.dirty = False
+        with span('make_prediction'):
+            make_prediction(dfsw, self.config, self.metadata, self.client,
+                            self.asset_index, savepoint=self.savepoint)
+        self.n_rows += dfsw.shape[0]
+        return dfsw.shape[0]
+
+    def renew(self, force:bool=False) -> bool:
+        '''
+        Renew the lease once a third of its lifetime has passed (always with
+        force), returns False if it was lost.
+        '''
+        if self.lease is None:
+            return True
+        if not force and time.time() - self.lease.last_renewal < self.lease.ttl / 3:
+            return True
+        if self.lease.renew():
+            return True
+        print("calibration service: lease taken over by another job, stopping without saving")
+        return False
+
+    def recover(self):
+        '''
+        Restart from the last checkpoint after a poll failed while filtering,
+        the filter and the cursor may have advanced past each other. The
+        points since the checkpoint are filtered again.
+        '''
+        self.close()
+        old = self.savepoint
+        self.savepoint = CalibrationSavepoint(old.s3_bucket, old.filename,
+                                              history_prefix = old.history_prefix,
+                                              retention = old.retention,
+                                              local_dir = old.local_dir)
+        with span('savepoint_load'):
+            self.savepoint.load()
+        self.dirty = False
+
+    def checkpoint(self) -> bool:
+        #never save over the savepoint of the job that took the lease over
+        if not self.renew(force=True):
+            return False
+        with span('savepoint_save', checkpoint=True):
+            self.savepoint.save()
+        self.last_checkpoint = time.monotonic()
+        return True
+
+    def wait_for_lease(self, deadline:float) -> bool:
+        #the previous job releases the lease after its final save
+        while not self.stopping.is_set():
+            if self.lease.acquire():
+                return True
+            if deadline is not None and time.monotonic() + self.poll_seconds >= deadline:
+                return False
+            self.stopping.wait(self.poll_seconds)
+        return False
+
+    def run(self, runtime:float=None):
+        '''
+        Poll until SIGTERM (e.g. from Batch), SIGINT or stop(), or until
+        runtime seconds have passed, then save the savepoint and shut the
+        worker pool down. The time spent waiting for the lease counts
+        against the runtime.
+        '''
+        for signum in [signal.SIGTERM, signal.SIGINT]:
+            signal.signal(signum, self.stop)
+        start = time.monotonic()
+        deadline = None if runtime is None else start + runtime
+        if self.lease is not None:
+            if not self.wait_for_lease(deadline):
+                print("calibration service: savepoint lease not free, exiting")
+                self.close()
+                return
+            with span('savepoint_load'):
+                self.savepoint.load()
+        owned = True
+        failures = 0
+        try:
+            while not self.stopping.is_set():
+                t0 = time.monotonic()
+                #a transient SiteWise or S3 error (throttling, network) only
+                #delays the next poll, SIGTERM and the deadline end the loop
+                try:
+                    self.poll()
+                    if not self.renew():
+                        owned = False
+                        break
+                    if time.monotonic() - self.last_checkpoint >= self.checkpoint_seconds:
+                        if not self.checkpoint():
+                            owned = False
+                            break
+                    failures = 0
+                except Exception:
+                    failures += 1
+                    count('service_poll_errors')
+                    print(f"calibration service: poll failed ({failures} in a row)")
+                    traceback.print_exc()
+                    try:
+                        if self.dirty:
+                            self.recover()
+                        #keep the lease while backing off
+                        if not self.renew():
+                            owned = False
+                            break
+                    except Exception:
+                        traceback.print_exc()
+                if deadline is not None and time.monotonic() >= deadline:
+                    break
+                delay = self.poll_seconds if failures == 0 else \
+                    min(self.poll_seconds * 2**failures, self.max_backoff_seconds)
+                self.stopping.wait(max(delay - (time.monotonic() - t0), 0))
+        finally:
+            try:
+                if owned and not self.dirty:
+                    self.checkpoint()
+            finally:
+                if self.lease is not None:
+                    self.lease.release()
+                self.close()
+        print(f"calibration service: {self.n_rows} rows in {self.n_polls} polls")
+
+    def close(self):
+        for ukf in self.filters.values():
+            ukf.close()
+        self.filters = {}
 
 
 
@@ -273,11 +764,69 @@ if __name__ == '__main__':
 
     import argparse
     parser = argparse.ArgumentParser()
+    #batch array jobs run one child per asset and tell it its index
+    parser.add_argument('--asset-index', type=int,
+                        default=int(os.environ.get('AWS_BATCH_JOB_ARRAY_INDEX', 0)),
+                        help='entry of calibration_assets to calibrate')
+    parser.add_argument('--profile-startup', action='store_true',
+                        help='report the time spent before the first row is filtered')
+    parser.add_argument('--service', action='store_true',
+                        help='keep running and filter new points as they arrive')
+    parser.add_argument('--runtime', type=float, default=None,
+                        help='minutes the service runs, service_runtime_min if not set')
+    parser.add_argument('--local', action='store_true',
+                        help='run the service against an in-process SiteWise stand-in '
+                            +'fed with the replayed sample data, savepoint kept locally')
+    parser.add_argument('--fmu', default=None, help='override the fmu_file entry of the config')
+    parser.add_argument('--data', default='./assets/Case_1_Data_2023_06_22.csv',
+                        help='data replayed with --local')
+    parser.add_argument('--rate', type=float, default=1296.0,
+                        help='replay speed with --local, 1 is real time, the '
+                            +'default replays one sample per second')
     args = parser.parse_args()
 
     config = get_user_json_config('iot_config.json')
-
-    metadata = get_cloudformation_metadata('FMUCalibrationStack', region='us-east-1')
-    dfsw = get_data(config, metadata)
-    calibrate(dfsw, config, metadata)
-    make_prediction(dfsw, config, metadata)
\ No newline at end of file
+    if args.fmu is not None:
+        config['fmu_file'] = os.path.abspath(args.fmu)
+    asset_name = get_calibration_assets(config)[args.asset_index]
+    print(f"calibrating asset {args.asset_index}: {asset_name}")
+    #workers get the dimensions through the config as well
+    config['metrics_dimensions'] = {'asset': asset_name}
+    configure(config)
+
+    if args.profile_startup:
+        profile_startup(config, args.asset_index)
+    elif args.service:
+        client = None
+        if args.local:
+            from local_stubs import LocalSiteWiseClient, asset_property_names
+            from PushSiteWiseData_startBatchPredictions import simulate_data_into_sitewise
+            client = LocalSiteWiseClient()
+            assetId = client.create_asset(asset_name, asset_property_names(config))
+            metadata = {asset_logical_id(args.asset_index): assetId}
+            threading.Thread(target=simulate_data_into_sitewise, args=(assetId, config),
+                             kwargs={'rate': args.rate, 'client': client,
+                                     'filename': os.path.abspath(args.data)},
+                             daemon=True).start()
+        else:
+            with span('get_metadata'):
+                metadata = get_stack_resources('FMUCalibrationStack', region='us-east-1')
+        #the savepoint is only loaded once the lease on it is held
+        savepoint = get_savepoint(config, metadata, args.asset_index, load=False)
+        lease = SavepointLease(savepoint, config.get('service_lease_seconds', 300))
+        service = CalibrationService(config, metadata, savepoint,
+                                     client, args.asset_index, lease)
+        runtime = args.runtime if args.runtime is not None \
+                    else config.get('service_runtime_min')
+        service.run(None if runtime is None else 60 * float(runtime))
+    else:
+        with span('get_metadata'):
+            metadata = get_stack_resources('FMUCalibrationStack', region='us-east-1')
+        savepoint = get_savepoint(config, metadata, args.asset_index)
+        with span('get_data'):
+            dfsw = get_data(config, metadata, savepoint, asset_index=args.asset_index)
+        count('sitewise_rows', dfsw.shape[0])
+        with span('calibrate', rows=dfsw.shape[0]):
+            calibrate(dfsw, config, metadata, savepoint, asset_index=args.asset_index)
+        with span('make_prediction'):
+            make_prediction(dfsw, config, metadata, asset_index=args.asset_index)
@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+######################################################################
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved. #
+# SPDX-License-Identifier: MIT-0                                     #
+######################################################################
+
+#generic packages
+import os
+import atexit
+import pickle
+import shutil
+import multiprocessing.util
+import numpy as np
+import pandas
+
+#fmu packages
+from fmpy import read_model_description, extract
+from fmpy.fmi2 import FMU2Slave
+
+#local packages
+from metrics import configure, count, observe, timer
+
+#parsed model description stored next to a pre-unpacked fmu
+model_description_cache = 'modelDescription.pkl'
+
+#one fmu instance per (process, fmu file). Sigma points evaluated in the same
+#worker process reuse the loaded binary and only reset/re-parameterize it.
+_instances = {}
+
+
+def get_fmu_names(config:dict) -> tuple:
+    '''
+    Return the input and result variable names defined in the config.
+    '''
+    input_names = [value for key, value in config.items() if 'input' in key]
+    output_names = [value for key, value in config.items() if 'result' in key]
+    return input_names, output_names
+
+
+class FMUInstance(object):
+    '''
+    A co-simulation FMU that is unpacked, loaded and instantiated once and
+    then reset between evaluations.
+
+    :param fmu_file: path to the .fmu archive
+    :param input_names: FMU parameters set before each evaluation
+    :param output_names: FMU outputs returned by each evaluation
+    :param unzipdir: folder the FMU is unpacked to, a new temporary folder
+                     if None. A folder written by unpack_fmu is used as is.
+    '''
+    def __init__(self, fmu_file:str, input_names:list, output_names:list,
+                 unzipdir:str=None):
+        self.fmu_file = fmu_file
+        self.input_names = list(input_names)
+        self.output_names = list(output_names)
+
+        #unpacked at image build time, shared by every process
+        self.unpacked = unzipdir is not None \
+                        and os.path.isfile(os.path.join(unzipdir, 'modelDescription.xml'))
+        if self.unpacked:
+            self.unzipdir = unzipdir
+            self.model_description = load_model_description(unzipdir)
+        else:
+            self.model_description = read_model_description(fmu_file)
+            self.unzipdir = str(extract(fmu_file, unzipdir))
+        vrs = {v.name: v.valueReference for v in self.model_description.modelVariables}
+        self.input_vrs = [vrs[name] for name in self.input_names]
+        self.output_vrs = [vrs[name] for name in self.output_names]
+
+        self.fmu = FMU2Slave(guid=self.model_description.guid,
+                             unzipDirectory=self.unzipdir,
+                             modelIdentifier=self.model_description.coSimulation.modelIdentifier,
+                             instanceName=f'fmu_{os.getpid()}')
+        self.fmu.instantiate()
+        self.pid = os.getpid()
+        self.n_runs = 0
+
+        #warm start snapshots of converged FMU states, oldest first
+        self.snapshots = []
+        self.max_snapshots = 37
+        self.n_steps = 0
+        self.last_steps = 0
+        self.n_warm_runs = 0
+        self.n_cold_runs = 0
+        self.n_cold_steps = 0
+        self.n_steps_saved = 0
+
+    def simulate(self, inputs:np.array, step_size:float, stop_time:float,
+                 ss_iterations:int, ss_tolerance:float,
+                 warm_start:bool=False, adaptive:bool=False,
+                 max_step_size:float=None, ss_window:float=None) -> np.array:
+        '''
+        Apply the inputs and step until the outputs change by less than
+        ss_tolerance over ss_iterations steps or stop_time is hit.
+
+        With warm_start the FMU restarts from the stored converged state
+        whose inputs are closest to the requested ones instead of from t=0.
+
+        With adaptive the communication step grows up to max_step_size while
+        the outputs change slowly, and the run stops once the largest rate
+        of change of all outputs stayed below the rate implied
+        by ss_tolerance over ss_iterations steps for ss_window seconds of
+        simulated time, by default ss_iterations * step_size.
+        '''
+        inputs = np.asarray(inputs, dtype='float64')
+        snapshot = self._nearest_snapshot(inputs) if warm_start else None
+
+        if snapshot is None:
+            self.fmu.reset()
+            self.fmu.setupExperiment(startTime=0.0)
+            self.fmu.enterInitializationMode()
+            self.fmu.setReal(self.input_vrs, inputs.tolist())
+            self.fmu.exitInitializationMode()
+            t = 0.0
+            previous = None
+        else:
+            #damping coefficients are tunable, so they can be changed on the
+            #restored state without re-initializing the FMU
+            _, state, t, _ = snapshot
+            self.fmu.setFMUstate(state)
+            self.fmu.setReal(self.input_vrs, inputs.tolist())
+            #the stored outputs belong to other inputs, comparing against
+            #them could pass the first steady-state check too early
+            previous = None
+
+        t_end = t + stop_time
+        step = 0
+        outputs = np.array(self.fmu.getReal(self.output_vrs))
+        if adaptive:
+            t, step, outputs = self._step_adaptive(t, t_end, outputs, step_size,
+                                                   max_step_size or step_size,
+                                                   ss_tolerance / (ss_iterations * step_size),
+                                                   ss_window or ss_iterations * step_size)
+        else:
+            while t < t_end:
+                self.fmu.doStep(currentCommunicationPoint=t, communicationStepSize=step_size)
+                t += step_size
+                step += 1
+                #only read outputs when checking for steady state
+                if step % ss_iterations == 0:
+                    outputs = np.array(self.fmu.getReal(self.output_vrs))
+                    if previous is not None \
+                        and np.max(np.abs(outputs - previous)) < ss_tolerance:
+                        break
+                    previous = outputs
+            else:
+                outputs = np.array(self.fmu.getReal(self.output_vrs))
+
+        self.n_runs += 1
+        self.n_steps += step
+        self.last_steps = step
+        if snapshot is None:
+            self.n_cold_runs += 1
+            self.n_cold_steps += step
+        else:
+            self.n_warm_runs += 1
+            #savings are measured against the average cold start of this worker
+            if self.n_cold_runs > 0:
+                self.n_steps_saved += self.n_cold_steps / self.n_cold_runs - step
+        if warm_start:
+            self._store_snapshot(inputs, t, outputs)
+        return outputs
+
+    def _step_adaptive(self, t:float, t_end:float, outputs:np.array,
+                       step_size:float, max_step_size:float,
+                       rate_tolerance:float, window:float) -> tuple:
+        step = 0
+        h = step_size
+        #(step size, largest rate of change) of the steps in the window
+        rates = []
+        while t < t_end:
+            h = min(h, t_end - t)
+            self.fmu.doStep(currentCommunicationPoint=t, communicationStepSize=h)
+            t += h
+            step += 1
+            previous = outputs
+            outputs = np.array(self.fmu.getReal(self.output_vrs))
+            #same outputs as the fixed step criterion
+            rate = np.max(np.abs(outputs - previous)) / h
+            rates.append((h, rate))
+            while sum(x[0] for x in rates[1:]) >= window:
+                rates.pop(0)
+            if sum(x[0] for x in rates) >= window \
+                and max(x[1] for x in rates) < rate_tolerance:
+                break
+            #larger communication steps once the outputs change well below
+            #the steady-state rate, back to the base step size on transients
+            if rate < 0.5 * rate_tolerance:
+                h = min(2 * h, max_step_size)
+            elif rate > rate_tolerance:
+                h = max(0.5 * h, step_size)
+        return t, step, outputs
+
+    def _nearest_snapshot(self, inputs:np.array):
+        if len(self.snapshots) == 0:
+            return None
+        distance = [np.linalg.norm(x[0] - inputs) for x in self.snapshots]
+        return self.snapshots[int(np.argmin(distance))]
+
+    def _store_snapshot(self, inputs:np.array, t:float, outputs:np.array):
+        self.snapshots.append((inputs.copy(), self.fmu.getFMUstate(), t, outputs))
+        while len(self.snapshots) > self.max_snapshots:
+            self.fmu.freeFMUstate(self.snapshots.pop(0)[1])
+
+    def get_stats(self) -> dict:
+        return {'pid': self.pid,
+                'runs': self.n_runs,
+                'steps': self.n_steps,
+                'warm_runs': self.n_warm_runs,
+                'steps_saved': int(round(self.n_steps_saved))}
+
+    def close(self):
+        for snapshot in self.snapshots:
+            self.fmu.freeFMUstate(snapshot[1])
+        self.snapshots = []
+        try:
+            self.fmu.terminate()
+        except Exception:
+            #terminate is not allowed from every FMU state, always free
+            pass
+        self.fmu.freeInstance()
+        if not self.unpacked:
+            shutil.rmtree(self.unzipdir, ignore_errors=True)
+
+
+def unpack_fmu(fmu_file:str, unzipdir:str):
+    '''
+    Unpack the FMU and store its parsed model description, e.g. at image
+    build time, so the processes of every run load it without extracting
+    and parsing.
+    '''
+    extract(fmu_file, unzipdir)
+    with open(os.path.join(unzipdir, model_description_cache), 'wb') as f:
+        pickle.dump(read_model_description(unzipdir), f)
+
+
+def load_model_description(unzipdir:str):
+    try:
+        with open(os.path.join(unzipdir, model_description_cache), 'rb') as f:
+            return pickle.load(f)
+    except (OSError, pickle.UnpicklingError, AttributeError, ImportError):
+        #missing, or written by another fmpy version
+        return read_model_description(unzipdir)
+
+
+def get_fmu_instance(config:dict) -> FMUInstance:
+    '''
+    Return the FMU instance owned by the calling process, loading it on
+    first use.
+    '''
+    fmu_file = os.path.abspath(config['fmu_file'])
+    instance = _instances.get(fmu_file)
+    #forked workers inherit the parent dictionary, never share an instance
+    if instance is None or instance.pid != os.getpid():
+        input_names, output_names = get_fmu_names(config)
+        unzipdir = config.get('fmu_unpacked_dir')
+        if unzipdir is not None and not os.path.isdir(unzipdir):
+            #unpacked to a temporary folder of this process, removed on close
+            unzipdir = None
+        instance = FMUInstance(fmu_file, input_names, output_names, unzipdir)
+        instance.max_snapshots = config.get('fmu_warm_start_snapshots',
+                                            instance.max_snapshots)
+        _instances[fmu_file] = instance
+    return instance
+
+
+def get_pool_stats() -> list:
+    '''
+    Run and steady-state step counters of the FMU instances in this process.
+    '''
+    return [instance.get_stats() for instance in _instances.values()
+            if instance.pid == os.getpid()]
+
+
+def init_worker(config:dict):
+    '''
+    Process pool initializer that pays the FMU load cost once per worker.
+    '''
+    configure(config)
+    get_fmu_instance(config)
+    #pool workers exit without running atexit handlers
+    multiprocessing.util.Finalize(None, close_instances, exitpriority=10)
+
+
+def run_pooled_fmu(inputs:np.array, config:dict) -> pandas.DataFrame:
+    '''
+    Drop-in replacement for twinmodules run_fmu that evaluates the FMU on
+    the pooled instance of this process. Returns one row with the inputs and
+    the results at steady state.
+    '''
+    instance = get_fmu_instance(config)
+    steps = instance.n_steps
+    with timer('fmu_run_seconds'):
+        outputs = instance.simulate(inputs,
+                                    config['fmu_step_size'],
+                                    config['fmu_stop_time'],
+                                    config['fmu_ss_iterations'],
+                                    config['fmu_ss_tolerance'],
+                                    warm_start=config.get('fmu_warm_start', False),
+                                    adaptive=config.get('fmu_adaptive_step', False),
+                                    max_step_size=config.get('fmu_max_step_size'),
+                                    ss_window=config.get('fmu_ss_window'))
+    count('fmu_runs')
+    observe('fmu_ss_steps', instance.n_steps - steps)
+    row = dict(zip(instance.input_names, np.asarray(inputs, dtype='float64')))
+    row.update(zip(instance.output_names, outputs))
+    return pandas.DataFrame([row])
+
+
+@atexit.register
+def close_instances():
+    for fmu_file in list(_instances.keys()):
+        instance = _instances.pop(fmu_file)
+        if instance.pid == os.getpid():
+            if instance.n_warm_runs > 0:
+                stats = instance.get_stats()
+                print(f"fmu warm start (pid {stats['pid']}): {stats['warm_runs']} "
+                      +f"of {stats['runs']} runs warm, {stats['steps']} steps, "
+                      +f"~{stats['steps_saved']} steps saved")
+            instance.close()
+
+
+#%% main
+if __name__ == '__main__':
+
+    import argparse
+    parser = argparse.ArgumentParser(description='unpack an fmu for fmu_unpacked_dir')
+    parser.add_argument('fmu_file')
+    parser.add_argument('unzipdir')
+    args = parser.parse_args()
+
+    unpack_fmu(args.fmu_file, args.unzipdir)
+    print(f"unpacked {args.fmu_file} to {args.unzipdir}")
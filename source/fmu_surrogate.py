@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+######################################################################
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved. #
+# SPDX-License-Identifier: MIT-0                                     #
+######################################################################
+
+#generic packages
+import numpy as np
+from itertools import combinations_with_replacement
+
+
+class PolynomialSurrogate(object):
+    '''
+    Quadratic ridge regression of the state function trained on the real
+    FMU evaluations seen so far. Every prediction comes with an error
+    estimate, the predictive standard deviation from leave-one-out
+    residuals and the leverage of the query point, so callers can fall back
+    to the FMU where the surrogate is not trusted.
+
+    :param input_index: state components the state function depends on,
+                        e.g. the damping coefficients
+    :param tolerance: largest accepted error estimate, in output units, one
+                      value per output or a scalar for all of them
+    :param spread_fraction: the tolerance is also capped at this fraction of
+                            the spread of the predicted sigma points, 0
+                            disables
+    :param degree: polynomial degree, 1 or 2
+    :param ridge: regularization of the normal equations
+    :param max_samples: most recent FMU evaluations kept for training
+    :param verify_every: every n-th surrogate prediction is checked with
+                         the FMU anyway, 0 disables
+    '''
+    def __init__(self, input_index, tolerance, spread_fraction:float=0.1,
+                 degree:int=2, ridge:float=1e-8, max_samples:int=370,
+                 verify_every:int=50):
+        self.input_index = input_index
+        self.tolerance = np.asarray(tolerance, dtype='float64')
+        self.spread_fraction = spread_fraction
+        self.degree = degree
+        self.ridge = ridge
+        self.max_samples = max_samples
+        self.verify_every = verify_every
+
+        self.X = None
+        self.Y = None
+        self.coef = None
+        self.n_trusted = 0
+        self.n_predicted = 0
+        self.n_evaluated = 0
+        self.n_rejected = 0
+
+    def _features(self, Z:np.array) -> np.array:
+        features = [np.ones((Z.shape[0], 1)), Z]
+        if self.degree >= 2:
+            pairs = list(combinations_with_replacement(range(Z.shape[1]), 2))
+            features.append(np.stack([Z[:, i] * Z[:, j] for i, j in pairs], axis=1))
+        return np.hstack(features)
+
+    def _scale(self, X:np.array) -> np.array:
+        return (X[:, self.input_index] - self.x_mean) / self.x_scale
+
+    def add_samples(self, X:np.array, Y:np.array):
+        '''
+        Add real state function evaluations and refit.
+        '''
+        X = np.atleast_2d(X)
+        Y = np.atleast_2d(Y)
+        self.n_evaluated += X.shape[0]
+        self.X = X if self.X is None else np.vstack((self.X, X))[-self.max_samples:]
+        self.Y = Y if self.Y is None else np.vstack((self.Y, Y))[-self.max_samples:]
+        self.fit()
+
+    def fit(self):
+        inputs = self.X[:, self.input_index]
+        self.x_mean = inputs.mean(axis=0)
+        #sigma points are tightly clustered, guard against zero spread
+        self.x_scale = np.maximum(inputs.std(axis=0), 1e-12)
+        F = self._features(self._scale(self.X))
+        #need clearly more samples than coefficients for a usable estimate
+        if F.shape[0] < 2 * F.shape[1]:
+            self.coef = None
+            return
+
+        A = F.T @ F + self.ridge * np.eye(F.shape[1])
+        self.A_inv = np.linalg.inv(A)
+        self.coef = self.A_inv @ F.T @ self.Y
+        residual = self.Y - F @ self.coef
+        leverage = np.einsum('ij,jk,ik->i', F, self.A_inv, F)
+        loo = residual / np.clip(1 - leverage, 1e-6, None)[:, None]
+        self.rmse = np.sqrt(np.mean(loo**2, axis=0))
+
+    def predict(self, X:np.array) -> tuple:
+        '''
+        Returns the predicted next states and a boolean mask of the rows
+        whose error estimate is within tolerance.
+        '''
+        X = np.atleast_2d(X)
+        if self.coef is None:
+            return None, np.zeros((X.shape[0],), dtype=bool)
+        F = self._features(self._scale(X))
+        Y = F @ self.coef
+        leverage = np.einsum('ij,jk,ik->i', F, self.A_inv, F)
+        error = self.rmse[None, :] * np.sqrt(1 + leverage)[:, None]
+        tolerance = np.broadcast_to(self.tolerance, Y.shape[1:])
+        if self.spread_fraction > 0 and X.shape[0] > 1:
+            #the filter builds its covariance from the spread of the sigma
+            #points, an error comparable to it would distort the covariance
+            spread = Y.std(axis=0)
+            tolerance = np.where(spread > 0,
+                                 np.minimum(tolerance, self.spread_fraction * spread),
+                                 tolerance)
+        trusted = np.all(error < tolerance, axis=1)
+        self.n_rejected += int(np.sum(~trusted))
+
+        #periodically verify trusted predictions against the fmu
+        for i in np.flatnonzero(trusted):
+            self.n_trusted += 1
+            if self.verify_every > 0 and self.n_trusted % self.verify_every == 0:
+                trusted[i] = False
+        self.n_predicted += int(np.sum(trusted))
+        return Y, trusted
@@ -7,14 +7,15 @@
 
 #generic modules
 import json
-from tqdm import tqdm
+import copy
 import string
 from itertools import product
 import os
 import boto3
 
-#twinmodule packages
-from twinmodules.AWSModules.AWS_sitewise import get_asset_propert_id
+#local packages
+from stack_metadata import get_stack_metadata, find_resource
+from sitewise_io import get_calibration_assets, asset_logical_id, get_property_ids
 
 
 def copy_json_to_s3(local_file_path, bucket_name, s3_file_key):
@@ -55,77 +56,53 @@ def copy_json_to_s3(local_file_path, bucket_name, s3_file_key):
         print(f"An unexpected error occurred: {str(e)}")
         return False
 
-def get_asset_id(stack_name, asset_logical_id="MyCfnAsset"):
-    # Initialize CloudFormation and IoT SiteWise clients
-    cf_client = boto3.client('cloudformation')
+def get_asset_id(stack_name, asset_logical_id="MyCfnAsset", asset_name="web-handling-Asset"):
+    # The stack metadata is resolved once and reused across runs
     sitewise_client = boto3.client('iotsitewise')
 
     try:
-        # Get the physical ID of the asset from CloudFormation
-        response = cf_client.describe_stack_resource(
-            StackName=stack_name,
-            LogicalResourceId=asset_logical_id
-        )
-        physical_id = response['StackResourceDetail']['PhysicalResourceId']
-
-        # Use the physical ID to get the asset details from IoT SiteWise
-        response = sitewise_client.describe_asset(assetId=physical_id)
-        asset_name = response['assetName']
-
-        # Verify if the asset name matches "web-handling-Asset"
-        if asset_name == "web-handling-Asset":
+        # Get the physical ID of the asset from the stack metadata
+        metadata = get_stack_metadata(stack_name)
+        physical_id = metadata['resources'][asset_logical_id]
+
+        # Verify if the asset name matches
+        if metadata['asset_names'].get(physical_id) == asset_name:
             return physical_id
         else:
             # If the asset name doesn't match, search for it
             paginator = sitewise_client.get_paginator('list_assets')
             for page in paginator.paginate():
                 for asset in page['assetSummaries']:
-                    if asset['name'] == "web-handling-Asset":
+                    if asset['name'] == asset_name:
                         return asset['id']
 
-        raise Exception("Asset 'web-handling-Asset' not found")
+        raise Exception(f"Asset '{asset_name}' not found")
 
     except Exception as e:
         print(f"An error occurred: {str(e)}")
         return None
 
-#%% main
-if __name__ == '__main__':
-
-    stack_name = 'FMUCalibrationStack'
-
-    template_name = "./assets/MainFMUBoard-template.json"
-    configname = "iot_config.json"
-    if not os.path.isfile(template_name):
-        raise ValueError(f"ERROR: couldnt find {template_name} "
-                         +"try running this file one directory higher.")
-    if not os.path.isfile(configname):
-        raise ValueError(f"ERROR: couldnt find {template_name} "
-                         +"try running this file one directory higher.")
-
-    with open(template_name,'r') as f:
-        template = json.load(f)
-    with open(configname,'r') as f:
-        config = json.load(f)
-
-    #cloud formation provides the generated asset id
-    assetid = get_asset_id(stack_name)
-    #use twinmodules to determine the property ids
-    print("Finding property ids")
-
-    propertyids = {}
-    for x in tqdm(config.keys()):
+def dashboard_property_names(config):
+    # Properties shown on the dashboard, the uncertainty bands are two
+    # properties each
+    names = []
+    for x in config.keys():
         if 'result' in x.lower() or 'input' in x.lower():
-            tmp = get_asset_propert_id(config[x],assetid)
-            propertyids[tmp[0]] = tmp[-1]
+            names.append(config[x])
         elif 'uncertainty' in x.lower():
-            tmp = get_asset_propert_id(config[x]+'_lower',assetid)
-            propertyids[tmp[0]] = tmp[-1]
-            tmp = get_asset_propert_id(config[x]+'_upper',assetid)
-            propertyids[tmp[0]] = tmp[-1]
+            names.append(config[x]+'_lower')
+            names.append(config[x]+'_upper')
+    return names
 
-    print("Generating dashboard json")
+def generate_dashboard(template, assetid, propertyids):
+    """
+    Fill the dashboard template with the asset and property ids of one line.
 
+    :param template: Grafana dashboard template
+    :param assetid: SiteWise id of the asset shown
+    :param propertyids: property name to property id, in panel order
+    :return: the dashboard json
+    """
     #create an alphabet lookup for grafana numbering
     letters = list(string.ascii_uppercase)
     double_letters = product(letters, letters)
@@ -133,9 +110,9 @@ if __name__ == '__main__':
     letters.extend(double_letters)
 
     #update panel assetIds and property source ids
-    dashboard = template.copy()
+    dashboard = copy.deepcopy(template)
     new_panels =[]
-    for panel in template['panels']:
+    for panel in dashboard['panels']:
         #panel = template['panels'][1]
         panel_name = panel['title']
         new_target = []
@@ -167,8 +144,8 @@ if __name__ == '__main__':
                     new_target.append( tmp  )
                     cnt+=1
 
-            #add overrides for uncertainty bands
-            if 'damping' in panel_name.lower() and ("_lower" in name or '_upper' in name):
+            #add overrides for the uncertainty bands shown on this panel
+            if tmp in new_target and ("_lower" in name or '_upper' in name):
                 overrides.append(
                    {
                        "matcher": {
@@ -190,7 +167,7 @@ if __name__ == '__main__':
                        }
                     )
                 if '_upper' in name:
-                    var = name.split('_')[0]
+                    var = name[:-len('_upper')]
                     overrides[-1]['properties'].append(
                         {
                             "id": "custom.fillBelowTo",
@@ -207,24 +184,65 @@ if __name__ == '__main__':
 
     dashboard['panels'] = new_panels
 
-    local_file_path = 'generated_dashboard.json'
-    with open(local_file_path, 'w', encoding='utf-8') as f:
-        json.dump(dashboard, f, ensure_ascii=False, indent=4)
+    return dashboard
+
+#%% main
+if __name__ == '__main__':
+
+    stack_name = 'FMUCalibrationStack'
 
-    cf_client = boto3.client('cloudformation')
-    stack_resources = cf_client.describe_stack_resources(StackName=stack_name)
-    s3_bucket_resource = next((r for r in stack_resources['StackResources'] if r['ResourceType'] == 'AWS::S3::Bucket'), None)
-    s3_bucket_name = s3_bucket_resource['PhysicalResourceId']
+    template_name = "./assets/MainFMUBoard-template.json"
+    configname = "iot_config.json"
+    if not os.path.isfile(template_name):
+        raise ValueError(f"ERROR: couldnt find {template_name} "
+                         +"try running this file one directory higher.")
+    if not os.path.isfile(configname):
+        raise ValueError(f"ERROR: couldnt find {template_name} "
+                         +"try running this file one directory higher.")
 
-    copy_json_to_s3(local_file_path, s3_bucket_name, local_file_path)
+    with open(template_name,'r') as f:
+        template = json.load(f)
+    with open(configname,'r') as f:
+        config = json.load(f)
 
+    #the stack metadata provides the generated asset ids, one per line
+    metadata = get_stack_metadata(stack_name)
+    assets = get_calibration_assets(config)
+    assetids = [get_asset_id(stack_name, asset_logical_id(i), asset_name)
+                for i, asset_name in enumerate(assets)]
+    if None in assetids:
+        raise ValueError(f"ERROR: couldnt find the assets {assets} in {stack_name}")
 
-    dt_iam_resource = next((r for r in stack_resources['StackResources']
-                        if r['ResourceType'] == 'AWS::IAM::Role'
-                        and 'DemoTwinMakerRole' in r['LogicalResourceId']), None)
-    dt_iam_arn = dt_iam_resource['PhysicalResourceId']
+    #the property ids come with the stack metadata, an asset missing there is
+    #described once
+    print("Finding property ids")
+    names = dashboard_property_names(config)
+    asset_property_ids = {assetid: metadata['property_ids'][assetid]
+                          if assetid in metadata['property_ids'] else get_property_ids(assetid)
+                          for assetid in assetids}
+
+    s3_bucket_name = find_resource(metadata, 'AWS::S3::Bucket')
+    for i, (asset_name, assetid) in enumerate(zip(assets, assetids)):
+        print(f"Generating dashboard json for {asset_name}")
+        property_ids = asset_property_ids[assetid]
+        missing = [name for name in names if name not in property_ids]
+        if len(missing) > 0:
+            print(f"Properties not found on {asset_name}: {missing}")
+        propertyids = {name: property_ids[name] for name in names if name in property_ids}
+
+        dashboard = generate_dashboard(template, assetid, propertyids)
+
+        #the first line keeps the name used by the Grafana setup
+        if i == 0:
+            local_file_path = 'generated_dashboard.json'
+        else:
+            local_file_path = f'generated_dashboard_{asset_name}.json'
+        with open(local_file_path, 'w', encoding='utf-8') as f:
+            json.dump(dashboard, f, ensure_ascii=False, indent=4)
 
-    print(f"\nThe IAM ARN to copy into Grafana is: {dt_iam_arn}\n")
+        copy_json_to_s3(local_file_path, s3_bucket_name, local_file_path)
 
 
+    dt_iam_arn = find_resource(metadata, 'AWS::IAM::Role', 'DemoTwinMakerRole')
 
+    print(f"\nThe IAM ARN to copy into Grafana is: {dt_iam_arn}\n")
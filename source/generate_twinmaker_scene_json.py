@@ -7,6 +7,9 @@ import json
 import boto3
 import os
 
+#local packages
+from stack_metadata import get_stack_metadata, find_resource
+
 
 def find_entity_id(workspace_id, entity_name):
     # Create a TwinMaker client
@@ -37,48 +40,33 @@ def update_twinmaker_scene(scene_file_path, stack_name, property_names):
     with open(scene_file_path, 'r') as file:
         scene_data = json.load(file)
 
-    # Initialize boto3 clients
-    cf_client = boto3.client('cloudformation')
-    sitewise_client = boto3.client('iotsitewise')
+    # Stack ids, property ids and bucket are resolved once and reused
+    metadata = get_stack_metadata(stack_name)
 
     # Get S3 bucket name from CloudFormation stack
-    try:
-        stack_resources = cf_client.describe_stack_resources(StackName=stack_name)
-
-        s3_bucket_resource = next((r for r in stack_resources['StackResources'] if r['ResourceType'] == 'AWS::S3::Bucket'), None)
-
-        if s3_bucket_resource:
-            s3_bucket_name = s3_bucket_resource['PhysicalResourceId']
-
-            # Update S3 URI in scene data
-            for node in scene_data['nodes']:
-                for component in node.get('components', []):
-                    if component['type'] == 'ModelRef' and 's3://' in component['uri']:
-                        component['uri'] = f"s3://{s3_bucket_name}/twinmaker/3d-models/rollerTwin.gltf"
-        else:
-            print("S3 bucket not found in stack resources")
-    except Exception as e:
-        print(f"Error fetching S3 bucket from CloudFormation: {str(e)}")
+    s3_bucket_name = find_resource(metadata, 'AWS::S3::Bucket')
+    if s3_bucket_name:
+        # Update S3 URI in scene data
+        for node in scene_data['nodes']:
+            for component in node.get('components', []):
+                if component['type'] == 'ModelRef' and 's3://' in component['uri']:
+                    component['uri'] = f"s3://{s3_bucket_name}/twinmaker/3d-models/rollerTwin.gltf"
+    else:
+        print("S3 bucket not found in stack resources")
 
     # Get SiteWise asset ID from CloudFormation stack
     try:
-        twinmaker_workspace_id = next((r for r in stack_resources['StackResources'] if r['ResourceType'] == 'AWS::IoTTwinMaker::Workspace'), None)
-        if twinmaker_workspace_id:
-            twinmaker_workspace_id = twinmaker_workspace_id['PhysicalResourceId']
-
+        twinmaker_workspace_id = find_resource(metadata, 'AWS::IoTTwinMaker::Workspace')
 
         entity_id = find_entity_id(twinmaker_workspace_id, "WebHandlingEntity")
 
         scene_data['properties']["dataBindingConfig"]["template"]["sel_entity"] = entity_id
 
-        sitewise_asset_resource = next((r for r in stack_resources['StackResources'] if r['ResourceType'] == 'AWS::IoTSiteWise::Asset'), None)
-
-        if sitewise_asset_resource:
-            asset_id = sitewise_asset_resource['PhysicalResourceId']
+        asset_id = metadata['resources'].get('MyCfnAsset')
 
+        if asset_id:
             # Get SiteWise property IDs
-            asset_description = sitewise_client.describe_asset(assetId=asset_id)
-            property_ids = {prop['name']: prop['id'] for prop in asset_description['assetProperties']}
+            property_ids = metadata['property_ids'][asset_id]
 
             # Update property IDs in scene data
             for node in scene_data['nodes']:
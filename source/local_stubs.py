@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+######################################################################
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved. #
+# SPDX-License-Identifier: MIT-0                                     #
+######################################################################
+'''
+In-process stand-ins for the AWS services used by the calibration scripts,
+for local testing and benchmarking without a deployed stack. They mimic the
+request/response shapes of the boto3 clients for the calls used here.
+'''
+
+#generic packages
+import bisect
+import threading
+import uuid
+
+
+def asset_property_names(config:dict) -> list:
+    #same property list FMUCalibrationStack creates for the asset
+    names = []
+    for key, value in config.items():
+        if 'result' in key or 'input' in key or 'measured' in key:
+            names.append(value)
+        elif 'uncertainty' in key:
+            names.extend([value + '_lower', value + '_upper'])
+    return list(dict.fromkeys(names))
+
+
+class LocalSiteWiseClient(object):
+    '''
+    In-memory replacement for boto3.client('iotsitewise') holding DOUBLE
+    property values per asset.
+    '''
+    def __init__(self):
+        self.assets = {}
+        self.values = {}
+        self.n_calls = {}
+        self._lock = threading.Lock()
+
+    def _count(self, name:str):
+        self.n_calls[name] = self.n_calls.get(name, 0) + 1
+
+    def create_asset(self, asset_name:str, property_names:list) -> str:
+        assetId = str(uuid.uuid4())
+        self.assets[assetId] = {'name': asset_name,
+                                'properties': {name: str(uuid.uuid4())
+                                               for name in property_names}}
+        for propertyId in self.assets[assetId]['properties'].values():
+            self.values[(assetId, propertyId)] = ([], [])
+        return assetId
+
+    def describe_asset(self, assetId:str, **kwargs) -> dict:
+        with self._lock:
+            self._count('describe_asset')
+        asset = self.assets[assetId]
+        return {'assetId': assetId,
+                'assetName': asset['name'],
+                'assetProperties': [{'name': name, 'id': pid, 'dataType': 'DOUBLE'}
+                                    for name, pid in asset['properties'].items()]}
+
+    def _points(self, assetId:str, propertyId:str, startDate=None, endDate=None,
+                timeOrdering:str='ASCENDING') -> list:
+        times, values = self.values[(assetId, propertyId)]
+        lo = 0 if startDate is None else bisect.bisect_left(times, float(startDate))
+        hi = len(times) if endDate is None else bisect.bisect_right(times, float(endDate))
+        points = [{'value': {'doubleValue': values[i]},
+                   'timestamp': {'timeInSeconds': int(times[i]),
+                                 'offsetInNanos': int(round((times[i] - int(times[i])) * 1e9))},
+                   'quality': 'GOOD'}
+                  for i in range(lo, hi)]
+        if timeOrdering == 'DESCENDING':
+            points.reverse()
+        return points
+
+    def get_asset_property_value_history(self, assetId:str, propertyId:str,
+                                         startDate=None, endDate=None,
+                                         timeOrdering:str='ASCENDING',
+                                         maxResults:int=100, nextToken:str=None,
+                                         **kwargs) -> dict:
+        with self._lock:
+            self._count('get_asset_property_value_history')
+            points = self._points(assetId, propertyId, startDate, endDate, timeOrdering)
+        start = 0 if nextToken is None else int(nextToken)
+        response = {'assetPropertyValueHistory': points[start:start + maxResults]}
+        if start + maxResults < len(points):
+            response['nextToken'] = str(start + maxResults)
+        return response
+
+    def batch_get_asset_property_value_history(self, entries:list, maxResults:int=20000,
+                                               nextToken:str=None, **kwargs) -> dict:
+        if len(entries) > 16:
+            raise ValueError("ERROR: at most 16 entries per batch get request")
+        with self._lock:
+            self._count('batch_get_asset_property_value_history')
+            flat = []
+            for entry in entries:
+                for point in self._points(entry['assetId'], entry['propertyId'],
+                                          entry.get('startDate'), entry.get('endDate'),
+                                          entry.get('timeOrdering', 'ASCENDING')):
+                    flat.append((entry['entryId'], point))
+        start = 0 if nextToken is None else int(nextToken)
+        page = flat[start:start + maxResults]
+        response = {'successEntries': [{'entryId': entry['entryId'],
+                                        'assetPropertyValueHistory':
+                                            [p for eid, p in page if eid == entry['entryId']]}
+                                       for entry in entries],
+                    'errorEntries': [],
+                    'skippedEntries': []}
+        if start + maxResults < len(flat):
+            response['nextToken'] = str(start + maxResults)
+        return response
+
+    def batch_put_asset_property_value(self, entries:list, **kwargs) -> dict:
+        if len(entries) > 10:
+            raise ValueError("ERROR: at most 10 entries per batch put request")
+        with self._lock:
+            self._count('batch_put_asset_property_value')
+            for entry in entries:
+                if len(entry['propertyValues']) > 10:
+                    raise ValueError("ERROR: at most 10 values per batch put entry")
+                times, values = self.values[(entry['assetId'], entry['propertyId'])]
+                for point in entry['propertyValues']:
+                    t = point['timestamp']['timeInSeconds'] \
+                        + point['timestamp'].get('offsetInNanos', 0) * 1e-9
+                    i = bisect.bisect_left(times, t)
+                    #sitewise keeps the latest write for a timestamp
+                    if i < len(times) and times[i] == t:
+                        values[i] = point['value']['doubleValue']
+                    else:
+                        times.insert(i, t)
+                        values.insert(i, point['value']['doubleValue'])
+        return {'errorEntries': []}
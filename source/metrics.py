@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+######################################################################
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved. #
+# SPDX-License-Identifier: MIT-0                                     #
+######################################################################
+'''
+Lightweight instrumentation of the calibration job. Spans time the coarse
+stages and are written as one JSON line each, high frequency values such as
+single FMU runs are only aggregated per process and written once at exit.
+Batch sends stdout to CloudWatch Logs, with metrics_emf the lines are in
+CloudWatch Embedded Metric Format so CloudWatch extracts them as metrics.
+'''
+
+#generic packages
+import os
+import sys
+import json
+import time
+import atexit
+import multiprocessing
+import multiprocessing.util
+from contextlib import contextmanager
+
+_settings = {'enabled': True, 'emf': False, 'namespace': 'FMUCalibration',
+             'dimensions': {}}
+_counters = {}
+_observations = {}
+_registered = []
+
+
+def configure(config:dict):
+    '''
+    Apply the metrics_* entries of the config in this process. The entries
+    of metrics_dimensions (e.g. the asset name) are added to every record.
+    '''
+    _settings['enabled'] = config.get('metrics', True)
+    _settings['emf'] = config.get('metrics_emf', False)
+    _settings['namespace'] = config.get('metrics_namespace', 'FMUCalibration')
+    _settings['dimensions'] = dict(config.get('metrics_dimensions', {}))
+    if os.getpid() not in _registered:
+        _registered.append(os.getpid())
+        if multiprocessing.parent_process() is not None:
+            #forked workers start with a copy of the parent aggregates
+            _counters.clear()
+            _observations.clear()
+            #pool workers exit without running atexit handlers
+            multiprocessing.util.Finalize(None, flush, exitpriority=10)
+
+
+def emit(record:dict, units:dict=None, dimensions:list=()):
+    '''
+    Write one JSON line. units maps the numeric fields of the record that
+    are CloudWatch metrics to their unit and dimensions names extra fields
+    of the record to use as metric dimensions, both only for metrics_emf.
+    '''
+    if not _settings['enabled']:
+        return
+    record = dict(_settings['dimensions'], pid=os.getpid(), **record)
+    if _settings['emf'] and units:
+        dimensions = list(_settings['dimensions'].keys()) + list(dimensions)
+        record['_aws'] = {'Timestamp': int(time.time() * 1000),
+                          'CloudWatchMetrics': [{
+                              'Namespace': _settings['namespace'],
+                              'Dimensions': [dimensions],
+                              'Metrics': [{'Name': name, 'Unit': unit}
+                                          for name, unit in units.items()]}]}
+    sys.stdout.write(json.dumps(record) + '\n')
+    sys.stdout.flush()
+
+
+def count(name:str, value:float=1):
+    _counters[name] = _counters.get(name, 0) + value
+
+
+def observe(name:str, value:float):
+    '''
+    Aggregate a value (count, sum, min, max) without writing it.
+    '''
+    stats = _observations.get(name)
+    if stats is None:
+        _observations[name] = [1, value, value, value]
+    else:
+        stats[0] += 1
+        stats[1] += value
+        stats[2] = min(stats[2], value)
+        stats[3] = max(stats[3], value)
+
+
+@contextmanager
+def span(name:str, **fields):
+    '''
+    Time a stage, e.g. with span('get_data'): ..., and write it as one
+    record with the optional extra fields.
+    '''
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds = time.perf_counter() - t0
+        observe(name, seconds)
+        emit(dict(span=name, seconds=seconds, **fields),
+             units={'seconds': 'Seconds'}, dimensions=['span'])
+
+
+@contextmanager
+def timer(name:str):
+    '''
+    Like span, but only aggregated, for stages that run many times.
+    '''
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - t0)
+
+
+def get_summary() -> dict:
+    return {'counters': dict(_counters),
+            'observations': {name: {'count': n, 'sum': total, 'min': low, 'max': high,
+                                    'mean': total / n}
+                             for name, (n, total, low, high) in _observations.items()}}
+
+
+@atexit.register
+def flush():
+    '''
+    Write the counters and aggregated values of this process and reset them.
+    '''
+    if len(_counters) == 0 and len(_observations) == 0:
+        return
+    summary = get_summary()
+    record = {'summary': 'process'}
+    units = {}
+    for name, value in summary['counters'].items():
+        record[name] = value
+        units[name] = 'Count'
+    for name, stats in summary['observations'].items():
+        record[name + '_count'] = stats['count']
+        record[name + '_mean'] = stats['mean']
+        record[name + '_max'] = stats['max']
+        units[name + '_count'] = 'Count'
+        units[name + '_mean'] = 'None'
+        units[name + '_max'] = 'None'
+    emit(record, units)
+    _counters.clear()
+    _observations.clear()
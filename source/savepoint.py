@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+######################################################################
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved. #
+# SPDX-License-Identifier: MIT-0                                     #
+######################################################################
+
+#generic packages
+import os
+import json
+import time
+import fcntl
+import socket
+import hashlib
+import numpy as np
+
+#awswrangler is imported on first use of an S3 bucket, it is slow to import
+
+
+class CalibrationSavepoint(object):
+    '''
+    Filter savepoint with constant per-run I/O.
+
+    The latest filter state (e.g. mean and covariance) is kept in one small
+    npz file. The per-step history is written as one segment file per run
+    into a ring buffer of `retention` slots, so old history is overwritten
+    instead of growing the latest file without bound.
+
+    :param s3_bucket: bucket holding the savepoint, None keeps it local only
+    :param filename: name of the latest state file
+    :param history_prefix: folder for the history segments
+    :param retention: number of history segments (runs) kept, 0 disables
+    :param local_dir: local folder for the downloaded/written files
+    '''
+    version = 2
+
+    def __init__(self, s3_bucket:str=None,
+                 filename:str='ukf_savepoint.npz',
+                 history_prefix:str='ukf_history',
+                 retention:int=1440,
+                 local_dir:str='.'):
+        self.s3_bucket = s3_bucket
+        self.filename = filename
+        self.history_prefix = history_prefix
+        self.retention = retention
+        self.local_dir = local_dir
+
+        #latest filter state, saved as named arrays
+        self.data = {}
+        self.n_steps = 0
+        self.next_segment = 0
+        self._pending = {}
+
+    def _s3_path(self, name:str) -> str:
+        return f's3://{self.s3_bucket}/{name}'
+
+    def _local_path(self, name:str) -> str:
+        return os.path.join(self.local_dir, name)
+
+    def segment_name(self, segment:int) -> str:
+        #ring buffer slot, the oldest segment is overwritten
+        return f'{self.history_prefix}/segment_{segment % self.retention:06d}.npz'
+
+    def load(self) -> bool:
+        '''
+        Load the latest state, downloading it from S3 if a bucket is set.
+        Returns False if no savepoint exists yet.
+        '''
+        local_file = self._local_path(self.filename)
+        if self.s3_bucket is not None:
+            from awswrangler.s3 import does_object_exist, download
+            if not does_object_exist(self._s3_path(self.filename)):
+                return False
+            os.makedirs(os.path.dirname(local_file), exist_ok=True)
+            download(path=self._s3_path(self.filename), local_file=local_file)
+        elif not os.path.isfile(local_file):
+            return False
+
+        arr = np.load(local_file)
+        if 'calibrated_mean' in arr.files:
+            #unbounded savepoint written before segments existed, keep its
+            #history by writing it out as the first segment on save
+            self.data = {'mean': arr['calibrated_mean'][-1],
+                         'covariance': arr['calibrated_var'][-1]}
+            self.n_steps = arr['calibrated_mean'].shape[0] - 1
+            self._pending = {'mean': list(arr['calibrated_mean'][1:]),
+                             'covariance': list(arr['calibrated_var'][1:])}
+            return True
+
+        self.n_steps = int(arr['n_steps'])
+        self.next_segment = int(arr['next_segment'])
+        self.data = {key: arr[key] for key in arr.files
+                     if key not in ['version', 'n_steps', 'next_segment']}
+        return True
+
+    def append(self, **arrays):
+        '''
+        Record one filter step for the history, e.g. append(mean=m, covariance=P).
+        '''
+        for key, value in arrays.items():
+            self._pending.setdefault(key, []).append(np.array(value))
+
+    def save(self):
+        '''
+        Write the latest state and this run's history segment and upload
+        both. Only the latest file and one segment are transferred per run.
+        '''
+        n_new = len(next(iter(self._pending.values()), []))
+        first_step = self.n_steps - n_new + 1
+        files = []
+        if n_new > 0 and self.retention > 0:
+            name = self.segment_name(self.next_segment)
+            os.makedirs(os.path.dirname(self._local_path(name)), exist_ok=True)
+            np.savez(self._local_path(name),
+                     first_step=first_step,
+                     segment=self.next_segment,
+                     **{key: np.array(value) for key, value in self._pending.items()})
+            files.append(name)
+            self.next_segment += 1
+        self._pending = {}
+
+        os.makedirs(os.path.dirname(self._local_path(self.filename)), exist_ok=True)
+        np.savez(self._local_path(self.filename),
+                 version=self.version,
+                 n_steps=self.n_steps,
+                 next_segment=self.next_segment,
+                 **self.data)
+        files.append(self.filename)
+
+        if self.s3_bucket is not None:
+            from awswrangler.s3 import upload
+            for name in files:
+                upload(local_file=self._local_path(name), path=self._s3_path(name))
+
+    def step(self, **arrays):
+        '''
+        Set the latest state and record it in the history.
+        '''
+        self.data.update(arrays)
+        self.n_steps += 1
+        self.append(**arrays)
+
+    def load_history(self) -> dict:
+        '''
+        Read all locally available history segments ordered by step, for
+        offline analysis. Segments have to be synced from S3 beforehand.
+        '''
+        folder = self._local_path(self.history_prefix)
+        if not os.path.isdir(folder):
+            return {}
+        segments = [np.load(os.path.join(folder, x)) for x in os.listdir(folder)
+                    if x.startswith('segment_') and x.endswith('.npz')]
+        segments.sort(key=lambda x: int(x['segment']))
+        keys = [x for x in segments[0].files if x not in ['first_step', 'segment']] \
+                if len(segments) > 0 else []
+        return {key: np.concatenate([x[key] for x in segments]) for key in keys}
+
+
+class SavepointLease(object):
+    '''
+    Exclusive lease on a savepoint, so that two jobs never filter the same
+    points and overwrite each other's savepoint and cursor.
+
+    The lease is a small json file next to the savepoint with the owner and
+    the expiry time. It is only ever written conditionally, with If-None-Match
+    or If-Match on the ETag in S3 and under a file lock locally, so of several
+    jobs racing for it exactly one wins, and a holder notices on its next
+    renewal when another job has taken an expired lease over. A released or
+    expired lease (e.g. of a killed job) can be acquired by anyone.
+
+    :param savepoint: CalibrationSavepoint the lease protects
+    :param ttl: seconds the lease is valid without a renewal
+    :param owner: name of the holder, the Batch job id and process id if None
+    '''
+    def __init__(self, savepoint:CalibrationSavepoint, ttl:float=300.0, owner:str=None):
+        self.savepoint = savepoint
+        self.ttl = ttl
+        self.owner = owner if owner is not None else \
+            f"{os.environ.get('AWS_BATCH_JOB_ID', socket.gethostname())}:{os.getpid()}"
+        folder = os.path.dirname(savepoint.filename)
+        self.name = os.path.join(folder, 'ukf_lease.json') if folder else 'ukf_lease.json'
+        #tag of our last write, None while the lease is not held
+        self.tag = None
+        self.last_renewal = 0.0
+
+    @property
+    def held(self) -> bool:
+        return self.tag is not None
+
+    def _read(self):
+        '''
+        Current lease and its tag, (None, None) if there is none.
+        '''
+        if self.savepoint.s3_bucket is not None:
+            import boto3
+            from botocore.exceptions import ClientError
+            try:
+                response = boto3.client('s3').get_object(Bucket=self.savepoint.s3_bucket,
+                                                         Key=self.name)
+            except ClientError as e:
+                if e.response['Error']['Code'] in ['NoSuchKey', '404']:
+                    return None, None
+                raise
+            return json.loads(response['Body'].read()), response['ETag']
+        path = self.savepoint._local_path(self.name)
+        if not os.path.isfile(path):
+            return None, None
+        with open(path, 'rb') as f:
+            body = f.read()
+        return json.loads(body), hashlib.md5(body).hexdigest()
+
+    def _write(self, lease:dict, tag:str) -> bool:
+        '''
+        Write the lease if the current one still has the given tag (None: if
+        there is none), returns False if another job wrote in between.
+        '''
+        body = json.dumps(lease).encode()
+        if self.savepoint.s3_bucket is not None:
+            import boto3
+            from botocore.exceptions import ClientError
+            condition = {'IfNoneMatch': '*'} if tag is None else {'IfMatch': tag}
+            try:
+                response = boto3.client('s3').put_object(Bucket=self.savepoint.s3_bucket,
+                                                         Key=self.name, Body=body,
+                                                         **condition)
+            except ClientError as e:
+                if e.response['Error']['Code'] in ['PreconditionFailed',
+                                                   'ConditionalRequestConflict']:
+                    return False
+                raise
+            self.tag = response['ETag']
+            return True
+
+        path = self.savepoint._local_path(self.name)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path + '.lock', 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            current = None
+            if os.path.isfile(path):
+                with open(path, 'rb') as f:
+                    current = hashlib.md5(f.read()).hexdigest()
+            if current != tag:
+                return False
+            with open(path, 'wb') as f:
+                f.write(body)
+        self.tag = hashlib.md5(body).hexdigest()
+        return True
+
+    def acquire(self) -> bool:
+        '''
+        Take the lease if it is free, released or expired. Returns False if
+        another job holds it.
+        '''
+        lease, tag = self._read()
+        now = time.time()
+        if lease is not None and lease['owner'] != self.owner and lease['expires'] > now:
+            return False
+        if not self._write({'owner': self.owner, 'expires': now + self.ttl}, tag):
+            return False
+        self.last_renewal = now
+        return True
+
+    def renew(self) -> bool:
+        '''
+        Extend a held lease. Returns False and drops it if another job took it
+        over in the meantime, the caller must then stop without saving.
+        '''
+        if not self.held:
+            return False
+        now = time.time()
+        if not self._write({'owner': self.owner, 'expires': now + self.ttl}, self.tag):
+            self.tag = None
+            return False
+        self.last_renewal = now
+        return True
+
+    def release(self):
+        #an expired lease is free for the next job
+        if self.held:
+            self._write({'owner': self.owner, 'expires': 0}, self.tag)
+            self.tag = None
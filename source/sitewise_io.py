@@ -0,0 +1,328 @@
+# -*- coding: utf-8 -*-
+######################################################################
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved. #
+# SPDX-License-Identifier: MIT-0                                     #
+######################################################################
+
+#generic packages
+import json
+import time
+import random
+import numpy as np
+import pandas
+import boto3
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+
+#API limit of entries per BatchGetAssetPropertyValueHistory request
+max_batch_get_entries = 16
+#API limits of BatchPutAssetPropertyValue
+max_batch_put_entries = 10
+max_batch_put_values = 10
+#error codes worth retrying, everything else is a bad request
+retryable_errors = ['ThrottlingException', 'TooManyRequestsException',
+                    'LimitExceededException', 'ServiceUnavailableException',
+                    'InternalFailureException']
+#property name to id map of the assets described by this process
+_property_ids = {}
+
+
+def get_calibration_assets(config:dict) -> list:
+    '''
+    Names of the assets calibrated by the stack, one batch array child each.
+    '''
+    return config.get('calibration_assets', ['web-handling-Asset'])
+
+
+def asset_logical_id(asset_index:int) -> str:
+    #FMUCalibrationStack creates the assets as MyCfnAsset, MyCfnAsset1, ...
+    return 'MyCfnAsset' if asset_index == 0 else f'MyCfnAsset{asset_index}'
+
+
+def get_asset_id(config:dict, metadata:dict, asset_index:int=0) -> str:
+    '''
+    SiteWise id of the asset_index-th entry of calibration_assets.
+    '''
+    assets = get_calibration_assets(config)
+    if asset_index < 0 or asset_index >= len(assets):
+        raise ValueError(f"ERROR: asset index {asset_index} outside of the "
+                         +f"{len(assets)} calibration_assets")
+    return metadata[asset_logical_id(asset_index)]
+
+
+def get_property_ids(assetId:str, client=None) -> dict:
+    '''
+    Map every property name of the asset to its property id. The ids are
+    fixed for the lifetime of an asset, so every asset is described once
+    per process.
+    '''
+    if assetId not in _property_ids:
+        if client is None:
+            client = boto3.client('iotsitewise')
+        response = client.describe_asset(assetId=assetId)
+        _property_ids[assetId] = {prop['name']: prop['id']
+                                  for prop in response['assetProperties']}
+    return _property_ids[assetId]
+
+
+def _to_seconds(timestamp:dict) -> float:
+    return timestamp['timeInSeconds'] + timestamp.get('offsetInNanos', 0) * 1e-9
+
+
+def _history_frame(points:list, after:float=None) -> pandas.DataFrame:
+    df = pandas.DataFrame({'time': [_to_seconds(x['timestamp']) for x in points],
+                           'value': [x['value'].get('doubleValue', np.nan) for x in points]},
+                          dtype='float64')
+    if after is not None:
+        df = df[df['time'] > after]
+    return df.sort_values('time').reset_index(drop=True)
+
+
+def get_property_history(assetId:str, propertyId:str, after:float=None,
+                         latest:int=15, client=None) -> pandas.DataFrame:
+    '''
+    Fetch the values of one property as a [time, value] dataframe.
+
+    :param after: only return points strictly newer than this epoch time in
+                  seconds, following all pages. None returns the `latest`
+                  most recent points instead.
+    '''
+    if client is None:
+        client = boto3.client('iotsitewise')
+
+    request = {'assetId': assetId, 'propertyId': propertyId}
+    if after is None:
+        request.update(timeOrdering='DESCENDING', maxResults=latest)
+    else:
+        #startDate is inclusive and whole seconds are enough for the request,
+        #points at or before the cursor are dropped below
+        request.update(timeOrdering='ASCENDING', maxResults=20000,
+                       startDate=int(np.floor(after)))
+
+    points = []
+    while True:
+        response = client.get_asset_property_value_history(**request)
+        points.extend(response['assetPropertyValueHistory'])
+        if after is None or 'nextToken' not in response:
+            break
+        request['nextToken'] = response['nextToken']
+    return _history_frame(points, after)
+
+
+def batch_get_property_history(assetId:str, property_ids:dict, cursor:dict,
+                               client=None) -> dict:
+    '''
+    Fetch all points newer than the cursor for up to 16 properties with
+    BatchGetAssetPropertyValueHistory, following all pages.
+
+    :param property_ids: property name to property id
+    :param cursor: property name to epoch seconds of the last processed point
+    :return: property name to [time, value] dataframe
+    '''
+    if client is None:
+        client = boto3.client('iotsitewise')
+
+    names = list(property_ids.keys())
+    entries = [{'entryId': f'e{i}',
+                'assetId': assetId,
+                'propertyId': property_ids[name],
+                'startDate': int(np.floor(cursor[name])),
+                'timeOrdering': 'ASCENDING'}
+               for i, name in enumerate(names)]
+    points = {name: [] for name in names}
+    request = {'entries': entries, 'maxResults': 20000}
+    while True:
+        response = client.batch_get_asset_property_value_history(**request)
+        for entry in response.get('errorEntries', []):
+            raise ValueError(f"ERROR: SiteWise batch get failed for "
+                             +f"{names[int(entry['entryId'][1:])]}: {entry['errorMessage']}")
+        for entry in response['successEntries']:
+            points[names[int(entry['entryId'][1:])]].extend(entry['assetPropertyValueHistory'])
+        if 'nextToken' not in response:
+            break
+        request['nextToken'] = response['nextToken']
+
+    return {name: _history_frame(points[name], cursor[name]) for name in names}
+
+
+def get_properties_history(assetId:str, property_ids:dict, cursor:dict,
+                           latest:int=15, max_workers:int=16,
+                           client=None) -> dict:
+    '''
+    Fetch several properties concurrently. Properties with a cursor are read
+    with batch get calls of up to 16 entries, properties without one get
+    their `latest` most recent points.
+
+    :return: property name to [time, value] dataframe
+    '''
+    if client is None:
+        client = boto3.client('iotsitewise')
+
+    with_cursor = [name for name in property_ids if cursor.get(name) is not None]
+    without_cursor = [name for name in property_ids if cursor.get(name) is None]
+    chunks = [with_cursor[i:i+max_batch_get_entries]
+              for i in range(0, len(with_cursor), max_batch_get_entries)]
+
+    frames = {}
+    #boto3 clients are thread safe, the calls are I/O bound
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        batch_jobs = [executor.submit(batch_get_property_history, assetId,
+                                      {name: property_ids[name] for name in chunk},
+                                      cursor, client)
+                      for chunk in chunks]
+        single_jobs = {name: executor.submit(get_property_history, assetId,
+                                             property_ids[name], None, latest, client)
+                       for name in without_cursor}
+        for job in batch_jobs:
+            frames.update(job.result())
+        for name, job in single_jobs.items():
+            frames[name] = job.result()
+    return {name: frames[name] for name in property_ids}
+
+
+def align_streams(frames:dict, tolerance:float=0.0) -> pandas.DataFrame:
+    '''
+    Time align several [time, value] streams in one pass. Points whose
+    timestamps are within `tolerance` seconds of the previous point belong
+    to the same row, which gets the latest timestamp of its points. Rows
+    missing any stream are dropped.
+
+    :param frames: stream name to [time, value] dataframe
+    :return: dataframe with a time column and one column per stream
+    '''
+    names = list(frames.keys())
+    long = pandas.concat([df.assign(name=name) for name, df in frames.items()],
+                         ignore_index=True)
+    if long.shape[0] == 0:
+        return pandas.DataFrame(columns=['time'] + names, dtype='float64')
+
+    long = long.sort_values('time', kind='stable').reset_index(drop=True)
+    #a new row starts wherever the gap to the previous point exceeds tolerance
+    gap = np.diff(long['time'].to_numpy(), prepend=-np.inf)
+    long['row'] = np.cumsum(gap > tolerance)
+
+    dfsw = long.pivot_table(index='row', columns='name', values='value', aggfunc='last')
+    dfsw = dfsw.reindex(columns=names)
+    dfsw.insert(0, 'time', long.groupby('row')['time'].max())
+    dfsw.columns.name = None
+    return dfsw.dropna().reset_index(drop=True)
+
+
+def _timestamp(t:float) -> dict:
+    seconds = int(np.floor(t))
+    return {'timeInSeconds': seconds,
+            'offsetInNanos': min(int(round((t - seconds) * 1e9)), 999999999)}
+
+
+def pack_entries(assetId:str, values:dict, property_ids:dict) -> list:
+    '''
+    Pack property values into BatchPutAssetPropertyValue requests filled to
+    the API maximum of 10 entries with 10 values each.
+
+    :param values: property name to (times in epoch seconds, values)
+    :return: list of entry lists, one per request
+    '''
+    entries = []
+    for name, (times, data) in values.items():
+        points = [{'value': {'doubleValue': float(v)}, 'timestamp': _timestamp(t)}
+                  for t, v in zip(np.atleast_1d(times), np.atleast_1d(data))]
+        for i in range(0, len(points), max_batch_put_values):
+            entries.append({'entryId': f'{len(entries)}',
+                            'assetId': assetId,
+                            'propertyId': property_ids[name],
+                            'propertyValues': points[i:i+max_batch_put_values]})
+    return [entries[i:i+max_batch_put_entries]
+            for i in range(0, len(entries), max_batch_put_entries)]
+
+
+class SiteWiseBatchWriter(object):
+    '''
+    Sends property values with BatchPutAssetPropertyValue from a pool of
+    threads that stays alive between calls. Throttled requests and entries
+    are retried with exponential backoff and jitter.
+
+    :param assetId: asset receiving the values
+    :param property_ids: property name to property id
+    :param max_workers: concurrent requests in flight
+    :param max_retries: retries per request before giving up
+    :param backoff: first retry delay in seconds, doubled every retry
+    '''
+    def __init__(self, assetId:str, property_ids:dict, client=None,
+                 max_workers:int=8, max_retries:int=5, backoff:float=0.05):
+        self.assetId = assetId
+        self.property_ids = property_ids
+        self.client = client if client is not None else boto3.client('iotsitewise')
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.stats = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+    def _send_batch(self, entries:list) -> dict:
+        t0 = time.perf_counter()
+        n_entries = len(entries)
+        attempt = 0
+        while True:
+            try:
+                response = self.client.batch_put_asset_property_value(entries=entries)
+                failed_ids = set()
+                for error in response.get('errorEntries', []):
+                    codes = [x['errorCode'] for x in error['errors']]
+                    if any(code not in retryable_errors for code in codes):
+                        raise ValueError(f"ERROR: SiteWise rejected entry "
+                                         +f"{error['entryId']}: {error['errors']}")
+                    failed_ids.add(error['entryId'])
+                entries = [x for x in entries if x['entryId'] in failed_ids]
+            except ClientError as e:
+                if e.response['Error']['Code'] not in retryable_errors:
+                    raise
+            if len(entries) == 0:
+                break
+            if attempt >= self.max_retries:
+                raise RuntimeError(f"ERROR: SiteWise batch put still throttled "
+                                   +f"after {self.max_retries} retries")
+            time.sleep(self.backoff * 2**attempt * (1 + random.random()))
+            attempt += 1
+        return {'entries': n_entries,
+                'latency': time.perf_counter() - t0,
+                'retries': attempt}
+
+    def submit(self, values:dict) -> list:
+        '''
+        Queue values for sending, returns one future per request.
+
+        :param values: property name to (times in epoch seconds, values)
+        '''
+        return [self.executor.submit(self._send_batch, entries)
+                for entries in pack_entries(self.assetId, values, self.property_ids)]
+
+    def send(self, values:dict) -> list:
+        '''
+        Send values and wait for all requests, returns per-request stats.
+        '''
+        stats = []
+        for future in self.submit(values):
+            stats.append(future.result())
+        self.stats.extend(stats)
+        return stats
+
+
+def load_cursor(savepoint) -> dict:
+    '''
+    Per-property high-water marks (epoch seconds) stored in the savepoint.
+    '''
+    if 'sitewise_cursor' not in savepoint.data:
+        return {}
+    return json.loads(str(savepoint.data['sitewise_cursor']))
+
+
+def store_cursor(savepoint, cursor:dict):
+    savepoint.data['sitewise_cursor'] = np.array(json.dumps(cursor))
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+######################################################################
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved. #
+# SPDX-License-Identifier: MIT-0                                     #
+######################################################################
+'''
+Resolve the physical ids of the FMUCalibrationStack resources once instead
+of querying CloudFormation on every run.
+
+The ids are kept in a small versioned document:
+
+    {"format": 1, "stack_name": ..., "stack_id": ..., "stack_updated": ...,
+     "resources": {logical id: physical id},
+     "resource_types": {logical id: resource type},
+     "outputs": {output key: output value},
+     "asset_names": {asset id: asset name},
+     "property_ids": {asset id: {property name: property id}}}
+
+The calibration job gets it from the STACK_METADATA environment variable,
+which the CDK stack fills in the job definition, so a stack update that
+changes an id also deploys a new document. Scripts run outside of the job
+keep it in a local file and only check the time of the last stack update
+(one DescribeStacks call) before reusing it.
+'''
+
+#generic packages
+import os
+import json
+import tempfile
+import boto3
+from concurrent.futures import ThreadPoolExecutor
+
+#bump when the layout of the document changes
+metadata_format = 1
+#environment variable set by the CDK stack on the calibration job
+metadata_env = 'STACK_METADATA'
+#documents already resolved by this process
+_documents = {}
+
+
+def default_cache_file(stack_name:str, region:str=None) -> str:
+    name = f'stack_metadata_{stack_name}' + ('' if region is None else f'_{region}')
+    return os.path.join(tempfile.gettempdir(), name + '.json')
+
+
+def stack_version(stack_name:str, client=None) -> tuple:
+    '''
+    Stack id and time of the last create/update, changes on every deploy.
+    '''
+    if client is None:
+        client = boto3.client('cloudformation')
+    stack = client.describe_stacks(StackName=stack_name)['Stacks'][0]
+    updated = stack.get('LastUpdatedTime', stack['CreationTime'])
+    return stack['StackId'], str(updated)
+
+
+def fetch_stack_metadata(stack_name:str, region:str=None) -> dict:
+    '''
+    Query CloudFormation (and SiteWise for the property ids of the assets)
+    and return the metadata document.
+    '''
+    cf_client = boto3.client('cloudformation', region_name=region)
+    sitewise_client = boto3.client('iotsitewise', region_name=region)
+
+    stack = cf_client.describe_stacks(StackName=stack_name)['Stacks'][0]
+    document = {'format': metadata_format,
+                'stack_name': stack_name,
+                'stack_id': stack['StackId'],
+                'stack_updated': str(stack.get('LastUpdatedTime', stack['CreationTime'])),
+                'resources': {},
+                'resource_types': {},
+                'outputs': {output['OutputKey']: output['OutputValue']
+                            for output in stack.get('Outputs', [])},
+                'asset_names': {},
+                'property_ids': {}}
+
+    #DescribeStackResources stops at 100 resources, the list call pages
+    paginator = cf_client.get_paginator('list_stack_resources')
+    for page in paginator.paginate(StackName=stack_name):
+        for resource in page['StackResourceSummaries']:
+            if 'PhysicalResourceId' not in resource:
+                continue
+            document['resources'][resource['LogicalResourceId']] = resource['PhysicalResourceId']
+            document['resource_types'][resource['LogicalResourceId']] = resource['ResourceType']
+
+    #one line per asset, described concurrently
+    assetIds = [physical_id for logical_id, physical_id in document['resources'].items()
+                if document['resource_types'][logical_id] == 'AWS::IoTSiteWise::Asset']
+    with ThreadPoolExecutor(max_workers=max(1, min(16, len(assetIds)))) as executor:
+        responses = executor.map(lambda assetId: sitewise_client.describe_asset(assetId=assetId),
+                                 assetIds)
+        for assetId, response in zip(assetIds, responses):
+            document['asset_names'][assetId] = response['assetName']
+            document['property_ids'][assetId] = {prop['name']: prop['id']
+                                                 for prop in response['assetProperties']}
+    return document
+
+
+def load_stack_metadata(cache_file:str, stack_name:str):
+    '''
+    Read the local document, None if missing, unreadable or of another
+    stack or format.
+    '''
+    if not os.path.isfile(cache_file):
+        return None
+    try:
+        with open(cache_file, 'r') as f:
+            document = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if document.get('format') != metadata_format or document.get('stack_name') != stack_name:
+        return None
+    return document
+
+
+def store_stack_metadata(document:dict, cache_file:str):
+    #write and rename so that a concurrent reader never sees half a file
+    tmp_file = f'{cache_file}.{os.getpid()}'
+    with open(tmp_file, 'w') as f:
+        json.dump(document, f, indent=4)
+    os.replace(tmp_file, cache_file)
+
+
+def get_stack_metadata(stack_name:str='FMUCalibrationStack', region:str=None,
+                       cache_file:str=None, refresh:bool=False) -> dict:
+    '''
+    Return the metadata document of the stack.
+
+    :param stack_name: CloudFormation stack to resolve
+    :param region: region of the stack, None uses the default of boto3
+    :param cache_file: local copy of the document, default in the temp folder
+    :param refresh: ignore the environment and the local copy
+    '''
+    if not refresh and os.environ.get(metadata_env):
+        document = json.loads(os.environ[metadata_env])
+        if document.get('format') == metadata_format \
+            and document.get('stack_name') == stack_name:
+            document.setdefault('resource_types', {})
+            document.setdefault('outputs', {})
+            document.setdefault('asset_names', {})
+            document.setdefault('property_ids', {})
+            return document
+
+    if not refresh and (stack_name, region) in _documents:
+        return _documents[(stack_name, region)]
+
+    if cache_file is None:
+        cache_file = default_cache_file(stack_name, region)
+    document = None if refresh else load_stack_metadata(cache_file, stack_name)
+    if document is not None:
+        #a single cheap call decides whether the stack changed since
+        version = stack_version(stack_name, boto3.client('cloudformation', region_name=region))
+        if version != (document['stack_id'], document['stack_updated']):
+            document = None
+
+    if document is None:
+        document = fetch_stack_metadata(stack_name, region)
+        store_stack_metadata(document, cache_file)
+    _documents[(stack_name, region)] = document
+    return document
+
+
+def get_stack_resources(stack_name:str='FMUCalibrationStack', region:str=None,
+                        cache_file:str=None) -> dict:
+    '''
+    Logical to physical id of every resource of the stack, the layout of
+    twinmodules get_cloudformation_metadata.
+    '''
+    return get_stack_metadata(stack_name, region, cache_file)['resources']
+
+
+def find_resource(document:dict, resource_type:str, name_part:str=''):
+    '''
+    Physical id of the first resource of the given type whose logical id
+    contains name_part, None if there is none.
+    '''
+    for logical_id, physical_id in document['resources'].items():
+        if document['resource_types'].get(logical_id) == resource_type \
+            and name_part in logical_id:
+            return physical_id
+    return None
@@ -0,0 +1,174 @@
+import numpy as np
+
+from calibration_engine import StreamingUKF, SquareRootUKF, cholupdate
+from calibration_engine import EnsembleKF, gaspari_cohn, localization_matrix
+
+transition = np.array([[0.9, 0.1, 0.0],
+                       [0.0, 0.8, 0.2],
+                       [0.1, 0.0, 0.7]])
+
+
+def linear_model(x):
+    return transition @ x
+
+
+def make_filter(cls, **kwargs):
+    return cls(linear_model,
+               initial_state=np.ones(3),
+               initial_state_covariance=np.eye(3) * 1e-2,
+               measurement_noise=np.eye(2) * 1e-4,
+               process_noise=np.eye(3) * 1e-3,
+               n_observed=2,
+               ncpu=1,
+               **kwargs)
+
+
+def test_sr_ukf_matches_ukf_on_linear_model():
+    rng = np.random.default_rng(0)
+    ukf = make_filter(StreamingUKF)
+    sr_ukf = make_filter(SquareRootUKF)
+    for _ in range(20):
+        y = rng.normal(1.0, 0.1, size=2)
+        mean, covariance = ukf.step(y)
+        sr_mean, sr_covariance = sr_ukf.step(y)
+        np.testing.assert_allclose(sr_mean, mean, rtol=1e-8, atol=1e-12)
+        np.testing.assert_allclose(sr_covariance, covariance, rtol=1e-8, atol=1e-12)
+    np.testing.assert_allclose(sr_ukf.root @ sr_ukf.root.T, sr_covariance)
+
+
+def test_cholupdate_downdate():
+    rng = np.random.default_rng(1)
+    A = rng.normal(size=(4, 4))
+    x = rng.normal(size=4) * 0.1
+    covariance = A @ A.T + np.outer(x, x)
+    root = np.linalg.cholesky(covariance)
+
+    downdated = cholupdate(root, x, -1.0)
+    np.testing.assert_allclose(downdated @ downdated.T, A @ A.T, atol=1e-10)
+    np.testing.assert_allclose(downdated, np.tril(downdated))
+    #the update restores the original factor
+    np.testing.assert_allclose(cholupdate(downdated, x), root, atol=1e-10)
+
+
+def test_cholupdate_downdate_not_positive_definite():
+    root = np.eye(2)
+    try:
+        cholupdate(root, np.array([2.0, 0.0]), -1.0)
+    except np.linalg.LinAlgError:
+        return
+    raise AssertionError("downdate below zero did not raise")
+
+
+def test_gaspari_cohn():
+    distance = np.linspace(0, 3, 301)
+    taper = gaspari_cohn(distance, 1.0)
+    assert taper[0] == 1.0
+    assert np.all(taper[distance >= 2] == 0)
+    assert np.all(np.diff(taper) <= 1e-12)
+    #both branches meet at the radius
+    np.testing.assert_allclose(gaspari_cohn([1 - 1e-9, 1 + 1e-9], 1.0), 5/24, atol=1e-7)
+
+    localization = localization_matrix([0, 1, 1, 5], 1.0)
+    np.testing.assert_array_equal(localization, localization.T)
+    np.testing.assert_array_equal(np.diag(localization), 1.0)
+    assert localization[1, 2] == 1.0
+    assert localization[0, 3] == 0.0
+
+
+def test_enkf_matches_ukf_on_linear_model():
+    rng = np.random.default_rng(2)
+    ukf = make_filter(StreamingUKF)
+    enkf = make_filter(EnsembleKF, ensemble_size=4000, seed=0)
+    assert enkf.points_per_step() == 4000
+    for _ in range(5):
+        y = rng.normal(1.0, 0.1, size=2)
+        mean, covariance = ukf.step(y)
+        enkf_mean, enkf_covariance = enkf.step(y)
+    #sampling error of the ensemble only
+    assert np.all(np.abs(enkf_mean - mean) < 5 * np.sqrt(np.diag(covariance) / 4000))
+    np.testing.assert_allclose(enkf_covariance, covariance, rtol=0.1, atol=5e-5)
+
+
+def test_enkf_localization_cuts_distant_updates():
+    #the third state sits far from the two observed ones
+    localization = localization_matrix([0, 1, 10], 1.0)
+    enkf = make_filter(EnsembleKF, ensemble_size=50, seed=1, localization=localization)
+    ensemble = enkf.ensemble + np.linspace(0, 1, 50)[:, None]
+    analysed = enkf.analysis(np.array([2.0, 2.0]), ensemble)
+    np.testing.assert_array_equal(analysed[:, 2], ensemble[:, 2])
+    assert np.all(analysed[:, :2] != ensemble[:, :2])
+
+    unlocalized = make_filter(EnsembleKF, ensemble_size=50, seed=1)
+    assert np.all(unlocalized.analysis(np.array([2.0, 2.0]), ensemble)[:, 2] != ensemble[:, 2])
+
+
+output_matrix = np.array([[1.0, 2.0, 0.0],
+                          [0.0, 0.5, -1.0]])
+
+
+def linear_model_with_outputs(x):
+    state = transition @ x
+    return np.concatenate((state, output_matrix @ state))
+
+
+def test_output_moments_at_updated_state():
+    rng = np.random.default_rng(3)
+    for cls, kwargs in [(StreamingUKF, {}), (SquareRootUKF, {}),
+                        (EnsembleKF, {'ensemble_size': 40, 'seed': 0})]:
+        kalman = make_filter(cls, **kwargs)
+        kalman.state_func = linear_model_with_outputs
+        assert kalman.output_moments() is None
+        for _ in range(3):
+            kalman.step(rng.normal(1.0, 0.1, size=2))
+        mean, variance = kalman.output_moments()
+        #outputs linear in the state are exact at the posterior
+        np.testing.assert_allclose(mean, output_matrix @ kalman.mean, rtol=1e-9)
+        np.testing.assert_allclose(variance,
+                                   np.diag(output_matrix @ kalman.covariance @ output_matrix.T),
+                                   rtol=1e-6)
+
+
+def test_gate_inflates_close_measurements():
+    for cls in [StreamingUKF, SquareRootUKF]:
+        kalman = make_filter(cls, gate_threshold=1.0, gate_max_skips=3)
+        mean = kalman.mean.copy()
+        covariance = kalman.covariance.copy()
+        #the measurement the state function predicts at the mean
+        y = (transition @ mean)[:2]
+
+        kalman.step(y)
+        assert kalman.n_gated == 1
+        assert kalman.n_evaluations == 1
+        np.testing.assert_array_equal(kalman.mean, mean)
+        np.testing.assert_allclose(kalman.covariance, covariance + kalman.process_noise)
+
+        #the gate run is reused while the mean stays
+        kalman.step(y)
+        kalman.step(y)
+        assert kalman.n_gated == 3
+        assert kalman.n_evaluations == 1
+        np.testing.assert_allclose(kalman.covariance, covariance + 3 * kalman.process_noise)
+
+        #after gate_max_skips a full step is forced, its centre sigma point
+        #is the gate run
+        kalman.step(y)
+        assert kalman.n_gated == 3
+        assert kalman.n_evaluations == 1 + 2 * kalman.n
+        assert kalman.n_steps == 4
+
+
+def test_gate_passes_distant_measurements():
+    kalman = make_filter(StreamingUKF, gate_threshold=1.0)
+    reference = make_filter(StreamingUKF)
+    y = (transition @ kalman.mean)[:2] + 0.1
+    mean, covariance = kalman.step(y)
+    reference_mean, reference_covariance = reference.step(y)
+    assert kalman.n_gated == 0
+    #the gate run is the centre sigma point, the step is unchanged
+    assert kalman.n_evaluations == reference.n_evaluations
+    np.testing.assert_allclose(mean, reference_mean)
+    np.testing.assert_allclose(covariance, reference_covariance)
+
+    ungated = make_filter(StreamingUKF, gate_threshold=None)
+    ungated.step((transition @ ungated.mean)[:2])
+    assert ungated.n_gated == 0
@@ -0,0 +1,83 @@
+import os
+import numpy as np
+import pandas
+
+from fmu_cache import FMUResultCache, result_fields
+
+
+def make_config(tmp_path, **fields):
+    fmu_file = tmp_path / 'model.fmu'
+    if not fmu_file.exists():
+        fmu_file.write_bytes(b'fmu')
+    config = {'fmu_file': str(fmu_file), 'fmu_step_size': 0.1, 'fmu_stop_time': 1e6,
+              'fmu_ss_iterations': 50, 'fmu_ss_tolerance': 1e-3,
+              'input_0': 'b1', 'result_0': 'Roller1_w', 'measured_0': 'Roller1_w'}
+    config.update(fields)
+    return config
+
+
+def result(value):
+    return pandas.DataFrame([{'b1': value, 'Roller1_w': 2 * value}])
+
+
+def test_key_quantization(tmp_path):
+    cache = FMUResultCache(make_config(tmp_path), quantum=1e-7)
+    assert cache.key([1e-3, 2e-3]) == cache.key([1e-3 + 1e-9, 2e-3 - 1e-9])
+    assert cache.key([1e-3, 2e-3]) != cache.key([1e-3 + 1e-6, 2e-3])
+
+
+def test_key_covers_result_settings(tmp_path):
+    inputs = [1e-3, 2e-3]
+    base = FMUResultCache(make_config(tmp_path)).key(inputs)
+    changed = {'fmu_step_size': 0.2, 'fmu_stop_time': 10.0, 'fmu_ss_iterations': 10,
+               'fmu_ss_tolerance': 1e-6, 'fmu_adaptive_step': True,
+               'fmu_max_step_size': 2.0, 'fmu_ss_window': 5.0, 'fmu_warm_start': True,
+               'fmu_warm_start_snapshots': 3, 'fmu_instance_pool': False,
+               'measured_0': 'Roller2_w', 'result_1': 'Roller2_w', 'input_1': 'b2'}
+    assert set(result_fields) <= set(changed)
+    for key, value in changed.items():
+        assert FMUResultCache(make_config(tmp_path, **{key: value})).key(inputs) != base, key
+    #settings that do not change the result keep the key
+    assert FMUResultCache(make_config(tmp_path, fmu_cache_entries=8)).key(inputs) == base
+
+    (tmp_path / 'other.fmu').write_bytes(b'other fmu')
+    other = make_config(tmp_path, fmu_file=str(tmp_path / 'other.fmu'))
+    assert FMUResultCache(other).key(inputs) != base
+
+
+def test_local_tier_shared_between_caches(tmp_path):
+    config = make_config(tmp_path)
+    writer = FMUResultCache(config, cache_dir=str(tmp_path / 'cache'))
+    writer.put([1e-3], result(1.0))
+
+    reader = FMUResultCache(config, cache_dir=str(tmp_path / 'cache'))
+    df = reader.get([1e-3])
+    pandas.testing.assert_frame_equal(df, result(1.0))
+    assert reader.stats['hits_local'] == 1
+    assert reader.get([2e-3]) is None
+    assert reader.stats['misses'] == 1
+
+
+def test_local_tier_lru_eviction(tmp_path):
+    config = make_config(tmp_path)
+    cache_dir = tmp_path / 'cache'
+    cache = FMUResultCache(config, cache_dir=str(cache_dir), max_local_bytes=1 << 30)
+    for i in range(10):
+        cache.put([i * 1e-3], result(float(i)))
+    files = {i: cache_dir / (cache.key([i * 1e-3]) + '.npz') for i in range(10)}
+    size = os.path.getsize(files[0])
+    #oldest first, then a local hit refreshes entry 0
+    for i, path in files.items():
+        os.utime(path, (1000 + i, 1000 + i))
+    reader = FMUResultCache(config, cache_dir=str(cache_dir))
+    assert reader.get([0.0]) is not None
+
+    cache.max_local_bytes = 6 * size
+    cache.evict()
+    kept = sorted(i for i, path in files.items() if path.exists())
+    #cut to 80% of the limit, the least recently used files go first
+    assert kept == [0, 7, 8, 9]
+
+    #below the limit nothing is removed
+    cache.evict()
+    assert sorted(i for i, path in files.items() if path.exists()) == kept
@@ -0,0 +1,37 @@
+import os
+import json
+import numpy as np
+import pytest
+
+pytest.importorskip('fmpy')
+
+from fmu_pool import FMUInstance, get_fmu_names
+
+root = os.path.join(os.path.dirname(__file__), '..', '..', '..')
+fmu_file = os.path.join(root, 'assets', 'web_line_3_linux.fmu')
+
+
+@pytest.fixture(scope='module')
+def instance():
+    with open(os.path.join(root, 'iot_config.json'), 'r') as f:
+        config = json.load(f)
+    input_names, output_names = get_fmu_names(config)
+    instance = FMUInstance(fmu_file, input_names, output_names)
+    yield instance
+    instance.close()
+
+
+def test_adaptive_steady_state_matches_reference(instance):
+    inputs = np.full(len(instance.input_names), 1e-3)
+    #far tighter tolerance than any calibration run
+    reference = instance.simulate(inputs, 0.1, 1e6, 50, 1e-8)
+
+    fixed = instance.simulate(inputs, 0.1, 1e6, 50, 1e-3)
+    fixed_steps = instance.last_steps
+    adaptive = instance.simulate(inputs, 0.1, 1e6, 50, 1e-3,
+                                 adaptive=True, max_step_size=2.0)
+
+    fixed_error = np.max(np.abs(fixed - reference))
+    adaptive_error = np.max(np.abs(adaptive - reference))
+    assert instance.last_steps <= fixed_steps
+    assert adaptive_error < 1.5 * fixed_error
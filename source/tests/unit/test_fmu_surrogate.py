@@ -0,0 +1,68 @@
+import numpy as np
+
+from fmu_surrogate import PolynomialSurrogate
+
+#measurement std of the sample data is about 3e-6
+tolerance = 0.1 * np.array([3e-6, 1e-5])
+
+
+def samples(rng, n, noise=0.0):
+    X = 1e-3 + rng.normal(scale=1e-4, size=(n, 2))
+    Y = np.c_[2 * X[:, 0] + X[:, 1]**2, X[:, 1]]
+    return X, Y + rng.normal(scale=noise, size=Y.shape)
+
+
+def test_untrained_surrogate_trusts_nothing():
+    rng = np.random.default_rng(0)
+    surrogate = PolynomialSurrogate(slice(0, 2), tolerance)
+    assert not surrogate.predict(samples(rng, 5)[0])[1].any()
+    #fewer samples than twice the 6 quadratic coefficients
+    surrogate.add_samples(*samples(rng, 11))
+    assert surrogate.coef is None
+    assert not surrogate.predict(samples(rng, 5)[0])[1].any()
+
+
+def test_exact_model_is_trusted():
+    rng = np.random.default_rng(1)
+    surrogate = PolynomialSurrogate(slice(0, 2), tolerance, verify_every=0)
+    surrogate.add_samples(*samples(rng, 60))
+    X, Y = samples(rng, 5)
+    predicted, trusted = surrogate.predict(X)
+    assert trusted.all()
+    np.testing.assert_allclose(predicted, Y, atol=1e-9)
+    assert surrogate.n_predicted == 5
+
+
+def test_noise_above_tolerance_falls_back():
+    rng = np.random.default_rng(2)
+    #leave-one-out residuals of the noise exceed a tenth of the std
+    surrogate = PolynomialSurrogate(slice(0, 2), tolerance)
+    surrogate.add_samples(*samples(rng, 60, noise=1e-5))
+    assert not surrogate.predict(samples(rng, 5)[0])[1].any()
+    assert surrogate.n_rejected == 5
+
+    #the same model passes an absolute tolerance far above the noise
+    loose = PolynomialSurrogate(slice(0, 2), 1e-3, spread_fraction=0)
+    loose.add_samples(*samples(rng, 60, noise=1e-5))
+    assert loose.predict(samples(rng, 5)[0])[1].all()
+
+
+def test_tolerance_capped_by_sigma_point_spread():
+    rng = np.random.default_rng(3)
+    surrogate = PolynomialSurrogate(slice(0, 2), 1e-3, spread_fraction=0.1, verify_every=0)
+    surrogate.add_samples(*samples(rng, 60, noise=1e-7))
+    spread = 1e-3 + np.r_[0, 1, -1][:, None] * np.array([[1e-4, 1e-4]])
+    assert surrogate.predict(spread)[1].all()
+    #sigma points closer than the surrogate error are not trusted
+    tight = 1e-3 + np.r_[0, 1, -1][:, None] * np.array([[1e-8, 1e-8]])
+    assert not surrogate.predict(tight)[1].any()
+
+
+def test_verify_every():
+    rng = np.random.default_rng(4)
+    surrogate = PolynomialSurrogate(slice(0, 2), tolerance, spread_fraction=0,
+                                    verify_every=4)
+    surrogate.add_samples(*samples(rng, 60))
+    trusted = surrogate.predict(samples(rng, 8)[0])[1]
+    #every fourth trusted prediction is checked with the fmu anyway
+    np.testing.assert_array_equal(np.flatnonzero(~trusted), [3, 7])
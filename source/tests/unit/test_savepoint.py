@@ -0,0 +1,137 @@
+import io
+import time
+import hashlib
+import numpy as np
+import boto3
+import pytest
+from botocore.exceptions import ClientError
+
+from savepoint import CalibrationSavepoint, SavepointLease
+
+
+def test_load_legacy_savepoint(tmp_path):
+    means = np.arange(12, dtype='float64').reshape(4, 3)
+    variances = np.stack([np.eye(3) * (i + 1) for i in range(4)])
+    np.savez(tmp_path / 'ukf_savepoint.npz', calibrated_mean=means, calibrated_var=variances)
+
+    savepoint = CalibrationSavepoint(local_dir=str(tmp_path))
+    assert savepoint.load()
+    assert savepoint.n_steps == 3
+    np.testing.assert_array_equal(savepoint.data['mean'], means[-1])
+    np.testing.assert_array_equal(savepoint.data['covariance'], variances[-1])
+
+    #the old history becomes the first segment and the file the new format
+    savepoint.save()
+    history = savepoint.load_history()
+    np.testing.assert_array_equal(history['mean'], means[1:])
+    np.testing.assert_array_equal(history['covariance'], variances[1:])
+
+    reloaded = CalibrationSavepoint(local_dir=str(tmp_path))
+    assert reloaded.load()
+    assert reloaded.n_steps == 3
+    assert reloaded.next_segment == 1
+    np.testing.assert_array_equal(reloaded.data['mean'], means[-1])
+
+
+def test_history_ring_buffer(tmp_path):
+    savepoint = CalibrationSavepoint(local_dir=str(tmp_path), retention=3)
+    for run in range(5):
+        for _ in range(2):
+            savepoint.step(mean=np.full(2, float(savepoint.n_steps)))
+        savepoint.save()
+
+    #only the last three runs are kept, one segment file each
+    assert len(list((tmp_path / 'ukf_history').iterdir())) == 3
+    history = savepoint.load_history()
+    np.testing.assert_array_equal(history['mean'][:, 0], np.arange(4, 10))
+
+    reloaded = CalibrationSavepoint(local_dir=str(tmp_path), retention=3)
+    assert reloaded.load()
+    assert reloaded.n_steps == 10
+    assert reloaded.next_segment == 5
+    np.testing.assert_array_equal(reloaded.data['mean'], np.full(2, 9.0))
+
+
+def test_load_missing_savepoint(tmp_path):
+    savepoint = CalibrationSavepoint(local_dir=str(tmp_path))
+    assert not savepoint.load()
+    assert savepoint.n_steps == 0
+
+
+class ConditionalS3(object):
+    #get_object/put_object with the If-Match/If-None-Match semantics of S3
+    def __init__(self):
+        self.objects = {}
+
+    def get_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise ClientError({'Error': {'Code': 'NoSuchKey'}}, 'GetObject')
+        body = self.objects[Key]
+        return {'Body': io.BytesIO(body), 'ETag': hashlib.md5(body).hexdigest()}
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None):
+        current = self.objects.get(Key)
+        if (IfNoneMatch == '*' and current is not None) or \
+            (IfMatch is not None and (current is None
+                                      or hashlib.md5(current).hexdigest() != IfMatch)):
+            raise ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'PutObject')
+        self.objects[Key] = Body
+        return {'ETag': hashlib.md5(Body).hexdigest()}
+
+
+@pytest.fixture(params=['local', 's3'])
+def savepoint(request, tmp_path, monkeypatch):
+    if request.param == 'local':
+        return CalibrationSavepoint(local_dir=str(tmp_path))
+    s3 = ConditionalS3()
+    monkeypatch.setattr(boto3, 'client', lambda service, **kwargs: s3)
+    return CalibrationSavepoint('bucket', local_dir=str(tmp_path))
+
+
+def test_lease_is_exclusive(savepoint):
+    first = SavepointLease(savepoint, ttl=60, owner='first')
+    second = SavepointLease(savepoint, ttl=60, owner='second')
+    assert first.acquire()
+    assert first.held
+    assert not second.acquire()
+    assert not second.held
+    assert first.renew()
+    #the holder may take its own lease again
+    assert first.acquire()
+
+    first.release()
+    assert not first.held
+    assert second.acquire()
+    assert not first.acquire()
+
+
+def test_expired_lease_is_taken_over(savepoint):
+    first = SavepointLease(savepoint, ttl=0.05, owner='first')
+    second = SavepointLease(savepoint, ttl=60, owner='second')
+    assert first.acquire()
+    time.sleep(0.1)
+    assert second.acquire()
+    #the stalled holder notices on its next renewal and must not save
+    assert not first.renew()
+    assert not first.held
+    assert second.renew()
+
+    #a takeover followed by a release is still a lost lease
+    second.ttl = 0.05
+    assert second.renew()
+    time.sleep(0.1)
+    third = SavepointLease(savepoint, ttl=60, owner='third')
+    assert third.acquire()
+    third.release()
+    assert not second.renew()
+
+
+def test_concurrent_acquire_has_one_winner(savepoint):
+    first = SavepointLease(savepoint, ttl=60, owner='first')
+    second = SavepointLease(savepoint, ttl=60, owner='second')
+    #both saw no lease, the second conditional write fails
+    lease, tag = first._read()
+    assert lease is None
+    assert first._write({'owner': 'first', 'expires': time.time() + 60}, tag)
+    assert not second._write({'owner': 'second', 'expires': time.time() + 60}, tag)
+    assert not second.held
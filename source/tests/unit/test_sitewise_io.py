@@ -0,0 +1,151 @@
+import numpy as np
+import pandas
+
+from sitewise_io import pack_entries, max_batch_put_entries, max_batch_put_values
+from sitewise_io import SiteWiseBatchWriter
+from sitewise_io import get_properties_history, load_cursor, store_cursor
+from sitewise_io import align_streams, get_property_ids
+from savepoint import CalibrationSavepoint
+from local_stubs import LocalSiteWiseClient
+
+
+class ThrottledClient(LocalSiteWiseClient):
+    #the first put of every request is throttled
+    def __init__(self):
+        super().__init__()
+        self.throttled = set()
+
+    def batch_put_asset_property_value(self, entries, **kwargs):
+        key = tuple(entry['entryId'] for entry in entries)
+        if key not in self.throttled:
+            self.throttled.add(key)
+            return {'errorEntries': [{'entryId': entry['entryId'],
+                                      'errors': [{'errorCode': 'ThrottlingException'}]}
+                                     for entry in entries]}
+        return super().batch_put_asset_property_value(entries, **kwargs)
+
+
+def make_asset(names, n_points=20):
+    client = LocalSiteWiseClient()
+    assetId = client.create_asset('line', names)
+    property_ids = {prop['name']: prop['id']
+                    for prop in client.describe_asset(assetId)['assetProperties']}
+    for i, name in enumerate(names):
+        times = list(np.arange(n_points) * 0.5 + 100.0)
+        client.values[(assetId, property_ids[name])] = (times, [t + i for t in times])
+    return client, assetId, property_ids
+
+
+def test_history_after_cursor():
+    names = [f'p{i}' for i in range(20)]
+    client, assetId, property_ids = make_asset(names)
+    #fractional cursor inside the whole second the request starts at
+    cursor = {name: 104.5 for name in names}
+    frames = get_properties_history(assetId, property_ids, cursor, client=client)
+
+    for i, name in enumerate(names):
+        np.testing.assert_array_equal(frames[name]['time'], np.arange(105.0, 110.0, 0.5))
+        np.testing.assert_array_equal(frames[name]['value'], frames[name]['time'] + i)
+    #20 properties with a cursor need two batch requests
+    assert client.n_calls['batch_get_asset_property_value_history'] == 2
+    assert 'get_asset_property_value_history' not in client.n_calls
+
+
+def test_history_without_cursor_takes_latest():
+    client, assetId, property_ids = make_asset(['a', 'b'])
+    frames = get_properties_history(assetId, property_ids, {'a': 105.0}, latest=3,
+                                    client=client)
+    np.testing.assert_array_equal(frames['a']['time'], np.arange(105.5, 110.0, 0.5))
+    np.testing.assert_array_equal(frames['b']['time'], [108.5, 109.0, 109.5])
+
+
+def test_cursor_survives_savepoint(tmp_path):
+    savepoint = CalibrationSavepoint(local_dir=str(tmp_path))
+    assert load_cursor(savepoint) == {}
+    store_cursor(savepoint, {'a': 104.5, 'b': 1.7e9 + 0.25})
+    savepoint.save()
+
+    reloaded = CalibrationSavepoint(local_dir=str(tmp_path))
+    assert reloaded.load()
+    assert load_cursor(reloaded) == {'a': 104.5, 'b': 1.7e9 + 0.25}
+
+
+def stream(times, values):
+    return pandas.DataFrame({'time': times, 'value': values}, dtype='float64')
+
+
+def test_align_streams_exact_times():
+    frames = {'a': stream([1.0, 2.0, 3.0], [10, 20, 30]),
+              'b': stream([1.0, 3.0, 4.0], [11, 31, 41])}
+    dfsw = align_streams(frames)
+    assert list(dfsw.columns) == ['time', 'a', 'b']
+    #rows missing a stream are dropped
+    np.testing.assert_array_equal(dfsw['time'], [1.0, 3.0])
+    np.testing.assert_array_equal(dfsw['a'], [10, 30])
+    np.testing.assert_array_equal(dfsw['b'], [11, 31])
+
+
+def test_align_streams_gap_tolerance():
+    frames = {'a': stream([1.00, 2.00, 3.00], [10, 20, 30]),
+              'b': stream([1.02, 2.03, 3.20], [11, 21, 31])}
+    dfsw = align_streams(frames, tolerance=0.05)
+    #points within the tolerance share a row stamped with the latest time,
+    #a larger gap starts a new row
+    np.testing.assert_allclose(dfsw['time'], [1.02, 2.03])
+    np.testing.assert_array_equal(dfsw['a'], [10, 20])
+    np.testing.assert_array_equal(dfsw['b'], [11, 21])
+
+    assert align_streams(frames).shape[0] == 0
+    assert align_streams({'a': stream([], []), 'b': stream([], [])}).shape[0] == 0
+
+
+def test_pack_entries_limits():
+    property_ids = {f'p{i}': f'id{i}' for i in range(7)}
+    values = {name: (np.arange(23) + 1.5, np.arange(23) * 0.1) for name in property_ids}
+    requests = pack_entries('asset', values, property_ids)
+
+    for entries in requests:
+        assert len(entries) <= max_batch_put_entries
+        assert len({entry['entryId'] for entry in entries}) == len(entries)
+        for entry in entries:
+            assert 0 < len(entry['propertyValues']) <= max_batch_put_values
+            assert entry['assetId'] == 'asset'
+
+    #every value is sent exactly once and the requests are filled up
+    entries = [entry for request in requests for entry in request]
+    assert len(entries) == 7 * 3
+    assert len(requests) == 3
+    for name, property_id in property_ids.items():
+        sent = [v['value']['doubleValue'] for entry in entries
+                if entry['propertyId'] == property_id for v in entry['propertyValues']]
+        np.testing.assert_allclose(sent, values[name][1])
+    first = requests[0][0]['propertyValues'][0]['timestamp']
+    assert first == {'timeInSeconds': 1, 'offsetInNanos': 500000000}
+
+
+def test_batch_writer_retries_throttled_entries():
+    client = ThrottledClient()
+    names = ['a', 'b', 'c']
+    assetId = client.create_asset('line', names)
+    property_ids = client.describe_asset(assetId)['assetProperties']
+    property_ids = {prop['name']: prop['id'] for prop in property_ids}
+    values = {name: (np.arange(25, dtype='float64'), np.arange(25) + i)
+              for i, name in enumerate(names)}
+
+    with SiteWiseBatchWriter(assetId, property_ids, client, backoff=0.001) as writer:
+        stats = writer.send(values)
+    assert len(stats) == 1
+    assert stats[0]['retries'] == 1
+    assert stats[0]['entries'] == 9
+    for i, name in enumerate(names):
+        times, data = client.values[(assetId, property_ids[name])]
+        np.testing.assert_array_equal(times, np.arange(25))
+        np.testing.assert_array_equal(data, np.arange(25) + i)
+
+
+def test_property_ids_described_once():
+    client, assetId, property_ids = make_asset(['a', 'b'])
+    calls = client.n_calls['describe_asset']
+    assert get_property_ids(assetId, client) == property_ids
+    assert get_property_ids(assetId, client) == property_ids
+    assert client.n_calls['describe_asset'] == calls + 1